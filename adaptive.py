@@ -0,0 +1,180 @@
+import time
+import zlib
+
+REPORT_KEYS = ("received", "dropped", "decode_ms", "jitter_ms", "delay_ms")
+
+
+class ReceiverStats:
+    # Client side: turns frame arrivals into the periodic report the server adapts on
+    def __init__(self):
+        self.reset()
+        self.min_transit = None
+        self.prev_transit = None
+        self.jitter = 0.0
+
+    def reset(self):
+        self.received = 0
+        self.dropped = 0
+        self.decode_time = 0.0
+        self.max_delay = 0.0
+
+    def frame(self, captured, decode_time):
+        transit = time.time() - captured
+        if self.prev_transit is not None:
+            # RFC 3550 interarrival jitter; the sender/receiver clock offset cancels out
+            self.jitter += (abs(transit - self.prev_transit) - self.jitter) / 16
+        self.prev_transit = transit
+        if self.min_transit is None or transit < self.min_transit:
+            self.min_transit = transit
+        self.max_delay = max(self.max_delay, transit - self.min_transit)
+        self.received += 1
+        self.decode_time += decode_time
+
+    def report(self):
+        report = {
+            "received": self.received,
+            "dropped": self.dropped,
+            "decode_ms": 1000 * self.decode_time / max(self.received, 1),
+            "jitter_ms": 1000 * self.jitter,
+            "delay_ms": 1000 * self.max_delay,
+        }
+        self.reset()
+        return report
+
+
+class QualityController:
+    # Server side: AIMD over JPEG quality, then resolution, then frame rate, driven by the
+    # worst receiver report seen since the last adjustment
+    def __init__(self, quality=(40, 90), scale=(0.5, 1.0), fps=(5, 30), max_delay_ms=100,
+                 max_jitter_ms=30, interval=1.0, stable_reports=3):
+        self.min_quality, self.max_quality = quality
+        self.min_scale, self.max_scale = scale
+        self.min_fps, self.max_fps = fps
+        self.max_delay_ms = max_delay_ms
+        self.max_jitter_ms = max_jitter_ms
+        self.interval = interval
+        self.stable_reports = stable_reports
+        self.quality = self.max_quality
+        self.scale = self.max_scale
+        self.fps = self.max_fps
+        self.worst = None
+        self.stable = 0
+        self.last_adjust = time.monotonic()
+
+    def add(self, report):
+        # Reports missing a field, or with one that isn't a number, are left out
+        report = {key: report.get(key) for key in REPORT_KEYS}
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in report.values()):
+            return
+        if self.worst is None:
+            self.worst = report
+        else:
+            for key, value in report.items():
+                self.worst[key] = max(self.worst.get(key, value), value)
+
+    def congested(self, report):
+        return (report["dropped"] > 0
+                or report["delay_ms"] > self.max_delay_ms
+                or report["jitter_ms"] > self.max_jitter_ms
+                or report["decode_ms"] > 1000 / self.fps)
+
+    def adjust(self):
+        # Returns True when any setting changed
+        now = time.monotonic()
+        if self.worst is None or now - self.last_adjust < self.interval:
+            return False
+        report, self.worst = self.worst, None
+        self.last_adjust = now
+        before = (self.quality, self.scale, self.fps)
+        if self.congested(report):
+            self.stable = 0
+            if self.quality > self.min_quality:
+                self.quality = max(self.min_quality, self.quality - 15)
+            elif self.scale > self.min_scale:
+                self.scale = max(self.min_scale, self.scale * 0.75)
+            else:
+                self.fps = max(self.min_fps, self.fps * 0.7)
+        else:
+            self.stable += 1
+            if self.stable < self.stable_reports:
+                return False
+            self.stable = 0
+            if self.fps < self.max_fps:
+                self.fps = min(self.max_fps, self.fps + 5)
+            elif self.scale < self.max_scale:
+                self.scale = min(self.max_scale, self.scale / 0.75)
+            else:
+                self.quality = min(self.max_quality, self.quality + 5)
+        return (self.quality, self.scale, self.fps) != before
+
+
+class FrameGovernor:
+    # Server side: paces capture. Frames run at the target rate while the picture changes and fall back
+    # to idle_fps once it has been still for idle_after seconds; the first changed frame restores the
+    # full rate. With a cpu_budget (in cores) the rate is also capped so the whole process stays within
+    # it, measured every window seconds from cpu_time, which also counts any encoder processes.
+    def __init__(self, idle_fps=1.0, idle_after=1.0, cpu_budget=None, window=2.0, cpu_time=time.process_time):
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.cpu_budget = cpu_budget
+        self.window = window
+        self.cpu_time = cpu_time
+        self.checksum = None
+        self.last_change = time.monotonic()
+        self.captures = 0
+        self.window_started = (time.monotonic(), cpu_time())
+        self.cpu_cores = 0.0
+        self.max_fps = None
+
+    def changed(self, frame):
+        # CRC of the raw pixels: exact, and about a millisecond for a grayscale 1080p frame
+        checksum = zlib.crc32(frame)
+        if checksum == self.checksum:
+            return False
+        self.checksum = checksum
+        self.last_change = time.monotonic()
+        return True
+
+    @property
+    def idle(self):
+        return time.monotonic() - self.last_change >= self.idle_after
+
+    def interval(self, fps):
+        # Seconds until the next capture when the target is fps
+        self.captures += 1
+        self.measure()
+        if self.idle:
+            fps = min(fps, self.idle_fps)
+        if self.max_fps is not None:
+            fps = min(fps, self.max_fps)
+        return 1.0 / fps
+
+    def measure(self):
+        now, cpu = time.monotonic(), self.cpu_time()
+        started, cpu_started = self.window_started
+        if now - started < self.window:
+            return
+        self.cpu_cores = (cpu - cpu_started) / (now - started)
+        if self.cpu_budget:
+            # Cost is roughly proportional to frame rate, so scale the achieved rate by the overshoot;
+            # below budget the same rule lifts the cap again
+            fps = self.captures / (now - started)
+            self.max_fps = max(self.idle_fps, fps * self.cpu_budget / max(self.cpu_cores, 1e-3))
+        self.window_started = (now, cpu)
+        self.captures = 0
+
+
+class ViewerLag:
+    # How many frames each viewer is behind the newest one sent, taken from the last sequence number
+    # in its reports; viewers that stop reporting are forgotten after timeout seconds
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.viewers = {}
+
+    def update(self, viewer, seq, latest_seq):
+        self.viewers[viewer] = (max(0, latest_seq - seq), time.monotonic())
+
+    def depths(self):
+        cutoff = time.monotonic() - self.timeout
+        self.viewers = {viewer: entry for viewer, entry in self.viewers.items() if entry[1] >= cutoff}
+        return {viewer: depth for viewer, (depth, _) in self.viewers.items()}
@@ -0,0 +1,192 @@
+import heapq
+import threading
+import time
+import numpy as np
+
+RATE = 44100
+CHANNELS = 1
+CHUNK = 1024
+
+# G.711 mu-law
+MULAW_BIAS = 0x84
+MULAW_CLIP = 32635
+MULAW_EXPONENT = np.concatenate([[0], np.floor(np.log2(np.arange(1, 256)))]).astype(np.int32)
+
+# IMA ADPCM
+ADPCM_STEPS = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+    107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871,
+    5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623,
+    27086, 29794, 32767], dtype=np.int32)
+ADPCM_INDEX = np.array([-1, -1, -1, -1, 2, 4, 6, 8], dtype=np.int32)
+ADPCM_BLOCK_HEADER = np.dtype([("predictor", "<i2"), ("index", "u1"), ("reserved", "u1")])
+
+
+class PcmCodec:
+    id = 0
+    name = "pcm"
+
+    def encode(self, samples):
+        return samples.astype("<i2").tobytes()
+
+    def decode(self, payload, count):
+        return np.frombuffer(payload, dtype="<i2", count=count)
+
+
+class MulawCodec:
+    # 8 bits per sample, every step vectorized
+    id = 1
+    name = "mulaw"
+
+    def encode(self, samples):
+        x = samples.astype(np.int32)
+        sign = (x < 0).astype(np.int32) << 7
+        x = np.minimum(np.abs(x), MULAW_CLIP) + MULAW_BIAS
+        exponent = MULAW_EXPONENT[x >> 7]
+        mantissa = (x >> (exponent + 3)) & 0x0F
+        return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+    def decode(self, payload, count):
+        byte = ~np.frombuffer(payload, dtype=np.uint8, count=count).astype(np.int32) & 0xFF
+        exponent = (byte >> 4) & 0x07
+        x = ((((byte & 0x0F) << 3) + MULAW_BIAS) << exponent) - MULAW_BIAS
+        return np.where(byte & 0x80, -x, x).astype(np.int16)
+
+
+class AdpcmCodec:
+    # IMA ADPCM at 4 bits per sample in independent blocks, each opened by its predictor and step index
+    # as in WAV files. ADPCM is sequential within a block, so the loop runs over sample positions and
+    # every block of the chunk advances together; a lost packet never corrupts the next one.
+    id = 2
+    name = "adpcm"
+
+    def __init__(self, block=64):
+        self.block = block
+
+    def encode(self, samples):
+        samples = samples.astype(np.int32)
+        blocks = -(-len(samples) // self.block)
+        x = np.zeros(blocks * self.block, dtype=np.int32)
+        x[:len(samples)] = samples
+        x = x.reshape(blocks, self.block)
+        predictor = x[:, 0].copy()
+        # Blocks are coded side by side, so instead of inheriting the previous block's step size each
+        # one starts from the step matching its own first few sample differences
+        start = np.abs(np.diff(x[:, :9], axis=1)).mean(axis=1)
+        index = np.minimum(np.searchsorted(ADPCM_STEPS, start), 88).astype(np.int32)
+        header = np.zeros(blocks, dtype=ADPCM_BLOCK_HEADER)
+        header["predictor"] = predictor
+        header["index"] = index
+        codes = np.empty_like(x)
+        for i in range(self.block):
+            step = ADPCM_STEPS[index]
+            diff = x[:, i] - predictor
+            negative = diff < 0
+            code = np.minimum(np.abs(diff) * 4 // step, 7)
+            predictor = self._step(predictor, step, code, negative)
+            index = np.minimum(np.maximum(index + ADPCM_INDEX[code], 0), 88)
+            codes[:, i] = code | (negative << 3)
+        packed = (codes[:, 0::2] | (codes[:, 1::2] << 4)).astype(np.uint8)
+        return header.tobytes() + packed.tobytes()
+
+    def decode(self, payload, count):
+        blocks = -(-count // self.block)
+        header = np.frombuffer(payload, dtype=ADPCM_BLOCK_HEADER, count=blocks)
+        packed = np.frombuffer(payload, dtype=np.uint8, offset=header.nbytes).reshape(blocks, self.block // 2)
+        codes = np.empty((blocks, self.block), dtype=np.int32)
+        codes[:, 0::2] = packed & 0x0F
+        codes[:, 1::2] = packed >> 4
+        predictor = header["predictor"].astype(np.int32)
+        index = header["index"].astype(np.int32)
+        out = np.empty((blocks, self.block), dtype=np.int16)
+        for i in range(self.block):
+            code = codes[:, i] & 0x07
+            predictor = self._step(predictor, ADPCM_STEPS[index], code, codes[:, i] & 0x08)
+            index = np.minimum(np.maximum(index + ADPCM_INDEX[code], 0), 88)
+            out[:, i] = predictor
+        return out.reshape(-1)[:count]
+
+    @staticmethod
+    def _step(predictor, step, code, negative):
+        delta = ((2 * code + 1) * step) >> 3
+        return np.minimum(np.maximum(np.where(negative, predictor - delta, predictor + delta), -32768), 32767)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    # Codecs are looked up by the id carried in every audio packet and by name on the command line
+    CODECS[codec.id] = codec
+    CODECS[codec.name] = codec
+
+
+for codec in (PcmCodec(), MulawCodec(), AdpcmCodec()):
+    register_codec(codec)
+
+
+class JitterBuffer:
+    # Holds decoded chunks until their playout time: capture timestamp plus a delay that follows the
+    # measured network jitter and never runs ahead of the video, which is shown as soon as it decodes.
+    # Chunks that miss their slot are dropped, so a slow sound card cannot make audio drift behind.
+    def __init__(self, min_delay=0.04, max_delay=0.5, late_tolerance=0.05):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.late_tolerance = late_tolerance
+        self.condition = threading.Condition()
+        self.packets = []
+        self.min_transit = None
+        self.prev_transit = None
+        self.jitter = 0.0
+        self.video_delay = None
+        self.late = 0
+        self.underruns = 0
+
+    def put(self, seq, timestamp, samples):
+        transit = time.time() - timestamp
+        with self.condition:
+            if self.prev_transit is not None:
+                self.jitter += (abs(transit - self.prev_transit) - self.jitter) / 16
+            self.prev_transit = transit
+            if self.min_transit is None or transit < self.min_transit:
+                self.min_transit = transit
+            heapq.heappush(self.packets, (seq, timestamp, samples))
+            self.condition.notify()
+
+    def sync_video(self, delay):
+        # delay is how long after capture the latest video frame reached the screen
+        with self.condition:
+            if self.video_delay is None:
+                self.video_delay = delay
+            else:
+                self.video_delay += (delay - self.video_delay) / 16
+
+    def delay(self):
+        # Capture-to-playout delay, including the sender/receiver clock offset folded into min_transit
+        audio = min(self.max_delay, self.min_delay + 4 * self.jitter)
+        delay = (self.min_transit or 0.0) + audio
+        if self.video_delay is not None:
+            delay = max(delay, min(self.video_delay, (self.min_transit or 0.0) + self.max_delay))
+        return delay
+
+    def get(self, timeout=0.5):
+        # Returns the next chunk once its playout time comes, or None
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                while self.packets and self.packets[0][1] + self.delay() + self.late_tolerance < now:
+                    heapq.heappop(self.packets)
+                    self.late += 1
+                remaining = deadline - time.monotonic()
+                wait = remaining
+                if self.packets:
+                    wait = self.packets[0][1] + self.delay() - now
+                    if wait <= 0:
+                        return heapq.heappop(self.packets)[2]
+                if remaining <= 0:
+                    if not self.packets:
+                        self.underruns += 1
+                    return None
+                self.condition.wait(min(wait, remaining))
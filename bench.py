@@ -0,0 +1,304 @@
+import argparse
+import glob
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+import zmq
+from multicast import MULTICAST_GROUP
+from pro import CURSOR_PORT_OFFSET, Server, Client
+
+
+def crop(frame, region):
+    if region is None:
+        return frame.copy()
+    left, top, width, height = region
+    return frame[top:top + height, left:left + width].copy()
+
+
+class StaticDesktop:
+    def __init__(self, width=1920, height=1080):
+        frame = np.full((height, width, 3), (30, 90, 140), dtype=np.uint8)
+        cv2.rectangle(frame, (0, height - 40), (width, height), (20, 20, 20), -1)
+        for i, (x, y) in enumerate([(80, 60), (width // 2, 120), (200, height // 2)]):
+            cv2.rectangle(frame, (x, y), (x + 700, y + 420), (240, 240, 240), -1)
+            cv2.rectangle(frame, (x, y), (x + 700, y + 30), (60, 60, 200), -1)
+            for line in range(12):
+                cv2.putText(frame, f"window {i} line {line}: the quick brown fox", (x + 10, y + 60 + line * 30),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1)
+        self.frame = frame
+
+    def __call__(self, region=None):
+        return crop(self.frame, region)
+
+
+class ScrollingText:
+    def __init__(self, width=1920, height=1080, speed=8):
+        page = np.full((height * 3, width, 3), 255, dtype=np.uint8)
+        for line in range(page.shape[0] // 24):
+            cv2.putText(page, f"{line:5d}  def handler(event): return dispatch(event.kind, event.payload)",
+                        (10, 20 + line * 24), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (20, 20, 20), 1)
+        self.page = page
+        self.height = height
+        self.speed = speed
+        self.offset = 0
+
+    def __call__(self, region=None):
+        self.offset = (self.offset + self.speed) % (self.page.shape[0] - self.height)
+        return crop(self.page[self.offset:self.offset + self.height], region)
+
+
+class MixedDesktop:
+    # Scrolling code with a video playing in a window over it, the case hybrid tile coding is for
+    def __init__(self, width=1920, height=1080, seed=0):
+        self.text = ScrollingText(width, height)
+        texture = np.random.default_rng(seed).integers(0, 256, (height // 3, width * 2, 3), dtype=np.uint8)
+        self.video = cv2.normalize(cv2.GaussianBlur(texture, (0, 0), 6), None, 0, 255, cv2.NORM_MINMAX)
+        self.window = (width // 2, height // 4, width // 3, height // 3)
+        self.frame = 0
+
+    def __call__(self, region=None):
+        screen = self.text()
+        x, y, w, h = self.window
+        shift = self.frame * 12 % (self.video.shape[1] - w)
+        screen[y:y + h, x:x + w] = self.video[:h, shift:shift + w]
+        self.frame += 1
+        return crop(screen, region)
+
+
+class VideoNoise:
+    def __init__(self, width=1920, height=1080, seed=0):
+        self.shape = (height, width, 3)
+        self.rng = np.random.default_rng(seed)
+
+    def __call__(self, region=None):
+        shape = self.shape if region is None else (region[3], region[2], 3)
+        return self.rng.integers(0, 256, shape, dtype=np.uint8)
+
+
+class PngReplay:
+    def __init__(self, pattern):
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            raise ValueError(f"No frames match {pattern}")
+        self.frames = [cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB) for path in paths]
+        self.index = 0
+
+    def __call__(self, region=None):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return crop(frame, region)
+
+
+class CircleCursor:
+    # Pointer sweeping a circle once every three seconds, so every poll is a move
+    def __init__(self, width=1920, height=1080):
+        self.center = (width // 2, height // 2)
+        self.radius = min(width, height) // 3
+
+    def __call__(self):
+        angle = time.monotonic() * 2 * math.pi / 3
+        x = self.center[0] + int(self.radius * math.cos(angle))
+        y = self.center[1] + int(self.radius * math.sin(angle))
+        return x, y, True, 0
+
+
+SOURCES = {
+    "static": StaticDesktop,
+    "scroll": ScrollingText,
+    "video": VideoNoise,
+    "mixed": MixedDesktop,
+}
+
+
+def paced(source, fps):
+    # Stands in for the fixed cost of a real screen grab
+    interval = 1.0 / fps
+    next_time = [time.perf_counter()]
+
+    def capture(region=None):
+        delay = next_time[0] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        next_time[0] = max(next_time[0] + interval, time.perf_counter())
+        return source(region)
+    return capture
+
+
+def percentiles(values, scale=1000.0):
+    if not values:
+        return None
+    values = np.asarray(values) * scale
+    return {
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p90": round(float(np.percentile(values, 90)), 3),
+        "p99": round(float(np.percentile(values, 99)), 3),
+        "max": round(float(values.max()), 3),
+    }
+
+
+def run_benchmark(source, duration=5.0, fps=30, transport="tcp", port=5599, loss=0.0, layer="full",
+                  **server_options):
+    # multicast sends frames to MULTICAST_GROUP on loopback, with loss of its datagrams dropped at random
+    group = MULTICAST_GROUP if transport == "multicast" else None
+    if transport == "inproc":
+        context = zmq.Context()
+        bind_endpoint = connect_endpoint = f"inproc://bench-{port}"
+    else:
+        context = None
+        bind_endpoint = f"tcp://127.0.0.1:{port}"
+        connect_endpoint = None
+
+    received = []
+
+    def on_frame(message, size, decode_time):
+        received.append((size, decode_time, time.time() - message.header.timestamp))
+
+    server = Server(port, source=paced(source, fps), context=context, endpoint=bind_endpoint, metrics=True,
+                    announce=False, cursor_source=CircleCursor(), multicast_group=group, **server_options)
+    if server.multicast:
+        server.multicast.loss = loss
+    client = Client("127.0.0.1", port, headless=True, on_frame=on_frame, context=context, endpoint=connect_endpoint,
+                    metrics=True, multicast_group=group, layer=layer)
+
+    client_thread = threading.Thread(target=client.start, daemon=True)
+    server_thread = threading.Thread(target=server.start, daemon=True)
+    client_thread.start()
+    time.sleep(0.3)  # Let the subscriber connect before the first keyframe goes out
+    cpu_started = server.cpu_time()
+    server_thread.start()
+    time.sleep(duration)
+    cpu = server.cpu_time() - cpu_started
+    server.stop()
+    client.close()
+    if context is not None:
+        context.term()
+    server_thread.join()
+    client_thread.join()
+
+    sizes = [size for size, _, _ in received]
+    server_stats = server.metrics.snapshot()
+    client_stats = client.metrics.snapshot()
+    return {
+        "source": type(source).__name__,
+        "codec": server.encoder.codec.name,
+        "color": server.color,
+        "layers": [served.name for served in server.layers],
+        "viewer_layer": layer,
+        "encode_processes": server.pool.processes if server.pool else 0,
+        "transport": transport,
+        "datagram_loss": loss if group else None,
+        "duration_s": duration,
+        "target_fps": fps,
+        "frames": len(received),
+        "fps": round(len(received) / duration, 2),
+        "dropped_frames": server.dropped_frames,
+        "unchanged_frames": server_stats["counters"].get("frames_unchanged", 0),
+        "cpu_cores": round(cpu / duration, 3),  # Server, its encoder processes and the client together
+        "bytes_per_frame": round(float(np.mean(sizes)), 1) if sizes else 0,
+        "kbit_per_s": round(sum(sizes) * 8 / duration / 1000, 1),
+        "published_kbit_per_s": {served.name: round(server_stats["counters"].get(f"bytes_sent_{served.name}", 0) * 8
+                                                 / duration / 1000, 1) for served in server.layers},
+        "encode_ms": server_stats["stages"].get("encode"),
+        "decode_ms": percentiles([decode for _, decode, _ in received]),
+        "compression_ratio": server.compression_ratios().get(server.encoder.codec.name),
+        "latency_ms": percentiles([latency for _, _, latency in received]),
+        "frames_lost": client_stats["counters"].get("frames_lost", 0),
+        "fec_recovered": client_stats["counters"].get("fec_recovered", 0),
+        "multicast_fallbacks": client_stats["counters"].get("multicast_fallbacks", 0),
+        "keyframes_requested": client_stats["counters"].get("keyframes_requested", 0),
+        "cursor_updates_per_s": round(client_stats["counters"].get("cursor_updates", 0) / duration, 1),
+        "server_stages": server_stats["stages"],
+        "client_stages": client_stats["stages"],
+    }
+
+
+# Each role is timed in a fresh interpreter, from `import pro` until everything it needs is loaded
+IMPORT_PROBE = """
+import sys, time
+started = time.perf_counter()
+import pro
+import lazy
+imported = time.perf_counter()
+lazy.load(*pro.ROLE_MODULES[sys.argv[1]])
+loaded = time.perf_counter()
+heavy = ["cv2", "numpy", "zmq", "zmq.asyncio", "asyncio", "PIL.Image", "PIL.ImageTk", "pyautogui", "pystray", "mss"]
+print(imported - started, loaded - started, *[name for name in heavy if name in sys.modules])
+"""
+
+
+def import_times(runs=5):
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for role in ("chooser", "server", "viewer"):
+        imported, loaded = [], []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, "-c", IMPORT_PROBE, role], cwd=here, capture_output=True,
+                                    text=True, check=True).stdout.split()
+            imported.append(float(output[0]))
+            loaded.append(float(output[1]))
+        results.append({
+            "role": role,
+            "import_pro_ms": percentiles(imported),
+            "role_ready_ms": percentiles(loaded),
+            "modules": output[2:],
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless loopback benchmark for Server and Client")
+    parser.add_argument("--source", nargs="+", default=["static", "scroll", "video"],
+                        choices=sorted(SOURCES) + ["replay"])
+    parser.add_argument("--frames", help="Glob of PNG files for the replay source")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--transport", choices=["tcp", "inproc", "multicast"], default="tcp")
+    parser.add_argument("--loss", type=float, default=0.0, help="Share of multicast datagrams to drop")
+    parser.add_argument("--fec-loss", type=float, default=0.01, help="Multicast loss the parity is sized for")
+    parser.add_argument("--port", type=int, default=5599)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--processes", type=int, default=0, help="Encode in a pool of this many processes")
+    parser.add_argument("--codec", nargs="+", default=["jpeg"], help="Run every source once per tile codec")
+    parser.add_argument("--layers", nargs="+", default=["full"], help="Simulcast layers the server publishes")
+    parser.add_argument("--layer", default="full", help="Layer the viewer subscribes to")
+    parser.add_argument("--color", action="store_true", help="Send YUV 4:2:0 color instead of grayscale")
+    parser.add_argument("--idle-fps", type=float, default=1.0)
+    parser.add_argument("--cpu-budget", type=float, help="Cores the server may use")
+    parser.add_argument("--output", help="Write JSON results here instead of stdout")
+    parser.add_argument("--imports", action="store_true", help="Time startup imports per role instead")
+    args = parser.parse_args()
+
+    results = []
+    if args.imports:
+        results = import_times()
+    for name in [] if args.imports else args.source:
+        for codec in args.codec:
+            if name == "replay":
+                source = PngReplay(args.frames)
+            else:
+                source = SOURCES[name](args.width, args.height)
+            results.append(run_benchmark(source, args.duration, args.fps, args.transport, args.port, args.loss,
+                                         args.layer, layers=args.layers, color=args.color,
+                                         encoder_workers=args.workers, idle_fps=args.idle_fps,
+                                         cpu_budget=args.cpu_budget, codecs=(codec,),
+                                         encode_processes=args.processes, fec_loss=args.fec_loss))
+            args.port += CURSOR_PORT_OFFSET + 1  # Past every side port, clear of the last run's TIME_WAIT
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1 @@
-pyinstaller --onefile --windowed --icon="icon.ico" --add-data "icon.ico;." pro.py
\ No newline at end of file
+pyinstaller --noconfirm pro.spec
\ No newline at end of file
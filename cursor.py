@@ -0,0 +1,121 @@
+import sys
+import cv2
+import numpy as np
+
+# The pointer is sent apart from the picture: read_cursor() is cheap enough to poll at 60 Hz, while
+# cursor_image() renders a shape once and is only called when the shape id changes. Shape 0 is a
+# plain arrow for platforms where the system cursor can't be read.
+ARROW_SHAPE = 0
+ARROW_OUTLINE = np.array([(0, 0), (0, 16), (4, 12), (7, 18), (9, 17), (6, 11), (11, 11)], dtype=np.int32)
+
+
+def read_cursor():
+    # (x, y, visible, shape id) of the system pointer, in desktop pixels
+    if sys.platform == "win32":
+        return _windows_cursor()
+    import pyautogui
+    x, y = pyautogui.position()
+    return x, y, True, ARROW_SHAPE
+
+
+def cursor_image(shape):
+    # (BGRA image, (hotspot x, hotspot y)) for a shape id returned by read_cursor
+    if shape == ARROW_SHAPE or sys.platform != "win32":
+        return arrow(), (0, 0)
+    return _windows_cursor_image(shape)
+
+
+def arrow():
+    image = np.zeros((20, 13, 4), dtype=np.uint8)
+    cv2.fillPoly(image, [ARROW_OUTLINE + 1], (255, 255, 255, 255))
+    cv2.polylines(image, [ARROW_OUTLINE + 1], True, (0, 0, 0, 255), 1)
+    return image
+
+
+if sys.platform == "win32":
+    import ctypes
+    from ctypes import wintypes
+
+    _user32 = ctypes.windll.user32
+    _gdi32 = ctypes.windll.gdi32
+    _CURSOR_SHOWING = 0x1
+    _DI_NORMAL = 0x3
+    _SM_CXCURSOR, _SM_CYCURSOR = 13, 14
+
+    class _CURSORINFO(ctypes.Structure):
+        _fields_ = [("cbSize", wintypes.DWORD), ("flags", wintypes.DWORD), ("hCursor", wintypes.HANDLE),
+                    ("ptScreenPos", wintypes.POINT)]
+
+    class _ICONINFO(ctypes.Structure):
+        _fields_ = [("fIcon", wintypes.BOOL), ("xHotspot", wintypes.DWORD), ("yHotspot", wintypes.DWORD),
+                    ("hbmMask", wintypes.HBITMAP), ("hbmColor", wintypes.HBITMAP)]
+
+    class _BITMAPINFOHEADER(ctypes.Structure):
+        _fields_ = [("biSize", wintypes.DWORD), ("biWidth", wintypes.LONG), ("biHeight", wintypes.LONG),
+                    ("biPlanes", wintypes.WORD), ("biBitCount", wintypes.WORD), ("biCompression", wintypes.DWORD),
+                    ("biSizeImage", wintypes.DWORD), ("biXPelsPerMeter", wintypes.LONG),
+                    ("biYPelsPerMeter", wintypes.LONG), ("biClrUsed", wintypes.DWORD),
+                    ("biClrImportant", wintypes.DWORD)]
+
+    # Handles are pointer sized; without these ctypes would truncate them to 32 bits
+    _user32.GetDC.restype = wintypes.HDC
+    _user32.DrawIconEx.argtypes = [wintypes.HDC, ctypes.c_int, ctypes.c_int, wintypes.HANDLE, ctypes.c_int,
+                                   ctypes.c_int, wintypes.UINT, wintypes.HBRUSH, wintypes.UINT]
+    _user32.GetIconInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(_ICONINFO)]
+    _user32.ReleaseDC.argtypes = [wintypes.HWND, wintypes.HDC]
+    _gdi32.CreateCompatibleDC.restype = wintypes.HDC
+    _gdi32.CreateCompatibleDC.argtypes = [wintypes.HDC]
+    _gdi32.CreateDIBSection.restype = wintypes.HBITMAP
+    _gdi32.CreateDIBSection.argtypes = [wintypes.HDC, ctypes.c_void_p, wintypes.UINT,
+                                        ctypes.POINTER(ctypes.c_void_p), wintypes.HANDLE, wintypes.DWORD]
+    _gdi32.SelectObject.restype = wintypes.HGDIOBJ
+    _gdi32.SelectObject.argtypes = [wintypes.HDC, wintypes.HGDIOBJ]
+    _gdi32.DeleteObject.argtypes = [wintypes.HGDIOBJ]
+    _gdi32.DeleteDC.argtypes = [wintypes.HDC]
+
+    def _windows_cursor():
+        info = _CURSORINFO(cbSize=ctypes.sizeof(_CURSORINFO))
+        if not _user32.GetCursorInfo(ctypes.byref(info)):
+            return 0, 0, False, ARROW_SHAPE
+        visible = bool(info.flags & _CURSOR_SHOWING) and bool(info.hCursor)
+        return info.ptScreenPos.x, info.ptScreenPos.y, visible, info.hCursor or ARROW_SHAPE
+
+    def _windows_cursor_image(handle):
+        # Draws the cursor once on black and once on white: where the two agree the pixel is opaque,
+        # where they differ by the full range it is transparent, which recovers alpha for old
+        # monochrome cursors as well as colour ones. Inverting pixels (the text I-beam) come out black.
+        icon = _ICONINFO()
+        if not _user32.GetIconInfo(handle, ctypes.byref(icon)):
+            return arrow(), (0, 0)
+        for bitmap in (icon.hbmMask, icon.hbmColor):
+            if bitmap:
+                _gdi32.DeleteObject(bitmap)
+        width, height = _user32.GetSystemMetrics(_SM_CXCURSOR), _user32.GetSystemMetrics(_SM_CYCURSOR)
+        header = _BITMAPINFOHEADER(biSize=ctypes.sizeof(_BITMAPINFOHEADER), biWidth=width, biHeight=-height,
+                                   biPlanes=1, biBitCount=32)
+        screen = _user32.GetDC(None)
+        dc = _gdi32.CreateCompatibleDC(screen)
+        bits = ctypes.c_void_p()
+        dib = _gdi32.CreateDIBSection(dc, ctypes.byref(header), 0, ctypes.byref(bits), None, 0)
+        previous = _gdi32.SelectObject(dc, dib)
+        try:
+            pixels = np.ctypeslib.as_array(ctypes.cast(bits, ctypes.POINTER(ctypes.c_uint8)),
+                                           shape=(height, width, 4))
+            drawn = []
+            for background in (0, 255):
+                pixels[...] = background
+                _user32.DrawIconEx(dc, 0, 0, handle, width, height, 0, None, _DI_NORMAL)
+                drawn.append(pixels[..., :3].astype(np.int16))
+        finally:
+            _gdi32.SelectObject(dc, previous)
+            _gdi32.DeleteObject(dib)
+            _gdi32.DeleteDC(dc)
+            _user32.ReleaseDC(None, screen)
+        on_black, on_white = drawn
+        alpha = np.clip(255 - (on_white - on_black).max(axis=2), 0, 255)
+        inverted = (on_white < on_black).all(axis=2)
+        color = np.where(alpha[..., None] > 0, on_black * 255 // np.maximum(alpha, 1)[..., None], 0)
+        color[inverted] = 0
+        alpha[inverted] = 255
+        image = np.dstack([np.clip(color, 0, 255), alpha]).astype(np.uint8)
+        return image, (icon.xHotspot, icon.yHotspot)
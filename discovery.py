@@ -0,0 +1,165 @@
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+# Hosts and relays announce themselves every second on a multicast group and by broadcast, so
+# viewers find them on networks that filter either one. The socket that sends the beacons also
+# answers probes, which is how viewers measure the round trip to each candidate.
+BEACON_PORT = 5670
+BEACON_GROUP = "239.255.77.77"
+SERVICE = "screenshare"
+PROBE = b"probe"
+
+
+def local_ip():
+    # Address of the interface that routes to the LAN, whatever the adapter is called
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect((BEACON_GROUP, BEACON_PORT))  # UDP connect sends nothing
+        return probe.getsockname()[0]
+    except OSError:
+        return "127.0.0.1"
+    finally:
+        probe.close()
+
+
+def new_stream_id():
+    return os.urandom(4).hex()
+
+
+class Beacon:
+    # kind is "server" or "relay"; a relay announces the stream id of the server it carries, so viewers
+    # can tell it is the same picture and pick whichever copy is closest
+    def __init__(self, port, kind="server", stream=None, name=None, caps=None, interval=1.0):
+        self.announcement = json.dumps({
+            "service": SERVICE,
+            "name": name or socket.gethostname(),
+            "kind": kind,
+            "port": port,
+            "stream": stream or new_stream_id(),
+            "caps": caps or {},
+        }).encode()
+        self.interval = interval
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.socket.bind(("", 0))
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        next_beacon = 0.0
+        while self.running:
+            now = time.monotonic()
+            if now >= next_beacon:
+                next_beacon = now + self.interval
+                for address in ((BEACON_GROUP, BEACON_PORT), ("255.255.255.255", BEACON_PORT)):
+                    try:
+                        self.socket.sendto(self.announcement, address)
+                    except OSError:
+                        pass  # No route for this kind of beacon right now; the other may still get out
+            ready, _, _ = select.select([self.socket], [], [], min(0.2, max(0.0, next_beacon - now)))
+            if ready:
+                try:
+                    data, sender = self.socket.recvfrom(64)
+                except OSError:
+                    continue
+                if data.startswith(PROBE):
+                    self.socket.sendto(data, sender)  # Echo the nonce straight back
+        self.socket.close()
+
+    def stop(self):
+        self.running = False
+
+
+def listen_socket():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(("", BEACON_PORT))
+    membership = struct.pack("4s4s", socket.inet_aton(BEACON_GROUP), socket.inet_aton("0.0.0.0"))
+    try:
+        listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    except OSError:
+        pass  # No multicast route; broadcast beacons still arrive
+    return listener
+
+
+def discover(timeout=1.5):
+    # Returns {(ip, beacon port): announcement} for everything heard within timeout; the announcement
+    # gains "ip" and "beacon" so it can be probed and joined
+    found = {}
+    listener = listen_socket()
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([listener], [], [], remaining)
+            if not ready:
+                continue
+            data, sender = listener.recvfrom(4096)
+            try:
+                announcement = json.loads(data)
+            except ValueError:
+                continue
+            if announcement.get("service") != SERVICE:
+                continue
+            announcement["ip"], announcement["beacon"] = sender
+            found[sender] = announcement
+    finally:
+        listener.close()
+    return found
+
+
+def probe(hosts, rounds=3, timeout=0.3):
+    # Probes every host at once from one socket and keeps the best of a few round trips, in seconds;
+    # hosts that never answer are left out
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rtts = {}
+    try:
+        for _ in range(rounds):
+            sent = {}
+            for address in hosts:
+                nonce = PROBE + os.urandom(8)
+                sent[nonce] = (address, time.perf_counter())
+                sender.sendto(nonce, address)
+            deadline = time.monotonic() + timeout
+            while sent:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                ready, _, _ = select.select([sender], [], [], remaining)
+                if not ready:
+                    continue
+                data, _ = sender.recvfrom(64)
+                if data in sent:
+                    address, started = sent.pop(data)
+                    rtt = time.perf_counter() - started
+                    rtts[address] = min(rtt, rtts.get(address, rtt))
+    finally:
+        sender.close()
+    return rtts
+
+
+def find_streams(timeout=1.5):
+    # One entry per stream, from the closest of the server and the relays carrying it, nearest first
+    found = discover(timeout)
+    rtts = probe(list(found))
+    streams = {}
+    for address in sorted(rtts, key=rtts.get):
+        announcement = found[address]
+        announcement["rtt"] = rtts[address]
+        streams.setdefault(announcement["stream"], announcement)
+    return list(streams.values())
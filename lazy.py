@@ -0,0 +1,30 @@
+import importlib
+
+
+class LazyModule:
+    # Stands in for a module until one of its attributes is first used, so the chooser window, the
+    # host and the viewer each import only what they touch. Looked-up attributes are kept on the proxy,
+    # so after the first use an access costs the same as on the module itself.
+    def __init__(self, name):
+        self.__dict__["_lazy_name"] = name
+        self.__dict__["_lazy_module"] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            module = self.__dict__["_lazy_module"] = importlib.import_module(self.__dict__["_lazy_name"])
+        value = getattr(module, attr)
+        self.__dict__[attr] = value
+        return value
+
+    def __repr__(self):
+        return f"<lazy module {self.__dict__['_lazy_name']!r}>"
+
+    def _load(self):
+        return self.__getattr__("__name__")
+
+
+def load(*modules):
+    # Imports the given lazy modules now rather than on first use
+    for module in modules:
+        module._load()
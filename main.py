@@ -3,9 +3,16 @@ from tkinter import simpledialog, messagebox
 import threading
 import pyautogui
 import pyaudio
+import time
 import cv2
 import numpy as np
+import asyncio
 import zmq
+import zmq.asyncio
+from tiles import DeltaEncoder, TileCanvas
+from protocol import SequenceTracker, pack_audio, parse_audio, parse_frame
+from metrics import create_metrics, serve_metrics
+from audio import CHANNELS, CHUNK, CODECS, RATE, JitterBuffer
 
 class ScreenShareApp(tk.Tk):
     def __init__(self):
@@ -40,11 +47,17 @@ class ScreenShareApp(tk.Tk):
             client.start()
 
 class Server:
-    def __init__(self, port):
+    def __init__(self, port, tile_size=64, keyframe_interval=2.0, metrics=False, stats_port=None, audio_codec="adpcm"):
         self.port = port
+        self.audio_codec = CODECS[audio_codec]
+        self.metrics = create_metrics(metrics or stats_port)
+        if stats_port:
+            serve_metrics(self.metrics, stats_port)
+        self.encoder = DeltaEncoder(tile_size=tile_size, keyframe_interval=keyframe_interval)
         self.context = zmq.Context()
         self.screen_socket = self.context.socket(zmq.PUB)
         self.audio_socket = self.context.socket(zmq.PUB)
+        self.screen_socket.setsockopt(zmq.SNDHWM, 16)  # Slow viewers drop frames instead of queueing seconds of them
         self.screen_socket.bind(f"tcp://*:{self.port}")
         self.audio_socket.bind(f"tcp://*:{self.port + 1}")
         print(f"Server started on port {self.port} for screen, {self.port + 1} for audio, waiting for connections...")
@@ -61,106 +74,155 @@ class Server:
 
     def capture_screen(self):
         while True:
+            started = time.perf_counter()
             screenshot = pyautogui.screenshot()
             frame = np.array(screenshot)
-            _, buffer = cv2.imencode('.jpg', frame)
-            self.screen_socket.send(buffer.tobytes())
-            print(f"Sent frame of size: {len(buffer)}")
+            encoding = time.perf_counter()
+            self.metrics.record("capture", encoding - started)
+            message = self.encoder.next_message(frame)
+            sending = time.perf_counter()
+            self.metrics.record("encode", sending - encoding)
+            if message is None:
+                continue  # Nothing changed since the last frame
+            self.screen_socket.send_multipart(message, copy=False)
+            self.metrics.record("send", time.perf_counter() - sending)
+            self.metrics.count("frames_sent")
+            self.metrics.count("bytes_sent", sum(len(part) for part in message))
 
     def capture_audio(self):
-        chunk = 1024
         format = pyaudio.paInt16
-        channels = 1
-        rate = 44100
         p = pyaudio.PyAudio()
 
         stream = p.open(format=format,
-                        channels=channels,
-                        rate=rate,
+                        channels=CHANNELS,
+                        rate=RATE,
                         input=True,
-                        frames_per_buffer=chunk)
+                        frames_per_buffer=CHUNK)
 
+        seq = 0
         while True:
-            data = stream.read(chunk)
-            self.audio_socket.send(data)
-            print("Sent audio chunk")
+            data = stream.read(CHUNK)
+            # read() returns once the last sample is in, so the chunk started one chunk length ago
+            captured = time.time() - CHUNK / RATE
+            samples = np.frombuffer(data, dtype=np.int16)
+            started = time.perf_counter()
+            payload = self.audio_codec.encode(samples)
+            self.metrics.record("audio_encode", time.perf_counter() - started)
+            message = pack_audio(seq, captured, self.audio_codec.id, CHANNELS, RATE, len(samples) // CHANNELS,
+                                 payload)
+            self.audio_socket.send_multipart(message)
+            seq += 1
+            self.metrics.count("audio_chunks_sent")
+            self.metrics.count("audio_bytes_sent", sum(len(part) for part in message))
 
 class Client:
-    def __init__(self, server_ip, port):
+    def __init__(self, server_ip, port, metrics=False, stats_port=None):
         self.server_ip = server_ip
         self.port = port
-        self.context = zmq.Context()
+        self.metrics = create_metrics(metrics or stats_port)
+        if stats_port:
+            serve_metrics(self.metrics, stats_port)
+        self.context = zmq.asyncio.Context()
+        self.connect()
+        self.screen = TileCanvas(cv2.IMREAD_COLOR)
+        self.sequence = SequenceTracker()
+        self.jitter = JitterBuffer()
+        self.metrics.gauge("audio_delay_ms", lambda: round(1000 * self.jitter.delay(), 1))
+        self.metrics.gauge("audio_late_chunks", lambda: self.jitter.late)
+        self.metrics.gauge("audio_underruns", lambda: self.jitter.underruns)
+        print(f"Connecting to server at {self.server_ip}:{self.port} for screen, {self.server_ip}:{self.port + 1} for audio")
+
+    def connect(self):
         self.screen_socket = self.context.socket(zmq.SUB)
         self.audio_socket = self.context.socket(zmq.SUB)
+        self.screen_socket.setsockopt(zmq.RCVHWM, 4)
         self.screen_socket.connect(f"tcp://{self.server_ip}:{self.port}")
         self.audio_socket.connect(f"tcp://{self.server_ip}:{self.port + 1}")
         self.screen_socket.setsockopt_string(zmq.SUBSCRIBE, "")
         self.audio_socket.setsockopt_string(zmq.SUBSCRIBE, "")
-        print(f"Connecting to server at {self.server_ip}:{self.port} for screen, {self.server_ip}:{self.port + 1} for audio")
 
     def start(self):
+        # Both sockets are served by one asyncio loop; only audio playback, which blocks on the sound
+        # card, keeps a thread of its own
         self.running = True
-        screen_thread = threading.Thread(target=self.receive_screen)
-        audio_thread = threading.Thread(target=self.receive_audio)
+        playback_thread = threading.Thread(target=self.play_audio)
+        playback_thread.start()
+        asyncio.run(self.receive())
+        playback_thread.join()
 
-        screen_thread.start()
-        audio_thread.start()
-
-        screen_thread.join()
-        audio_thread.join()
+    async def receive(self):
+        await asyncio.gather(self.receive_screen(), self.receive_audio())
 
-    def receive_screen(self):
+    async def receive_screen(self):
         while self.running:
             try:
-                buffer = self.screen_socket.recv()
-                if len(buffer) < 10:  # Arbitrary threshold to check for valid image data
-                    continue
-
-                frame = np.frombuffer(buffer, dtype=np.uint8)
-                frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
-                if frame is not None:
-                    cv2.imshow('Screen', frame)
+                batch = [await self.screen_socket.recv_multipart(copy=False)]
+                while await self.screen_socket.poll(0):
+                    batch.append(await self.screen_socket.recv_multipart(copy=False))
+                shown = None
+                for parts in batch:
+                    message = parse_frame(parts)
+                    if message is None or not self.sequence.accept(message.header):
+                        continue
+                    if self.screen.apply(message):
+                        shown = message
+                    else:
+                        print("Waiting for keyframe")
+                self.metrics.count("frames_conflated", len(batch) - 1)
+                if shown is not None:
+                    # Only the newest picture of a backlog is drawn
+                    cv2.imshow('Screen', self.screen.buffer)
                     cv2.waitKey(1)
-                else:
-                    print("Failed to decode frame")
+                    self.jitter.sync_video(time.time() - shown.header.timestamp)
             except zmq.error.ContextTerminated:
                 break
             except Exception as e:
                 print(f"Failed to receive screen data: {e}")
 
-    def receive_audio(self):
-        chunk = 1024
+    async def receive_audio(self):
+        while self.running:
+            try:
+                packet = parse_audio(await self.audio_socket.recv_multipart(copy=False))
+                if packet is None:
+                    continue
+                header, payload = packet
+                codec = CODECS.get(header.codec)
+                if codec is None:
+                    print(f"Unknown audio codec {header.codec}")
+                    continue
+                started = time.perf_counter()
+                samples = codec.decode(payload, header.samples * header.channels)
+                self.metrics.record("audio_decode", time.perf_counter() - started)
+                self.metrics.count("audio_chunks_received")
+                self.jitter.put(header.seq, header.timestamp, samples)
+            except zmq.error.ContextTerminated:
+                break
+            except Exception as e:
+                print(f"Failed to receive audio data: {e}")
+
+    def play_audio(self):
+        # Paced by the jitter buffer: each chunk is written when its capture time plus the playout delay
+        # comes round, which keeps it lined up with the video frames captured at the same moment
         format = pyaudio.paInt16
-        channels = 1  # Match the number of channels with the server
-        rate = 44100
         p = pyaudio.PyAudio()
 
         stream = p.open(format=format,
-                        channels=channels,
-                        rate=rate,
+                        channels=CHANNELS,  # Match the number of channels with the server
+                        rate=RATE,
                         output=True)
 
         while self.running:
-            try:
-                data = self.audio_socket.recv()
-                stream.write(data)
-            except zmq.error.ContextTerminated:
-                break
-            except Exception as e:
-                print(f"Failed to receive audio data: {e}")
+            samples = self.jitter.get()
+            if samples is not None:
+                stream.write(samples.tobytes())
 
     def reconnect(self):
         print("Reconnecting to server...")
         self.running = False
         time.sleep(1)  # Wait before reconnecting
         self.context.destroy()
-        self.context = zmq.Context()
-        self.screen_socket = self.context.socket(zmq.SUB)
-        self.audio_socket = self.context.socket(zmq.SUB)
-        self.screen_socket.connect(f"tcp://{self.server_ip}:{self.port}")
-        self.audio_socket.connect(f"tcp://{self.server_ip}:{self.port + 1}")
-        self.screen_socket.setsockopt_string(zmq.SUBSCRIBE, "")
-        self.audio_socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        self.context = zmq.asyncio.Context()
+        self.connect()
         self.running = True
         self.start()
 
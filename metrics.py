@@ -0,0 +1,150 @@
+import bisect
+import json
+import math
+import threading
+import time
+
+# Log-spaced bucket bounds from 10us to 100s, ~17% apart
+BOUNDS = [1e-5 * 10 ** (i / 15) for i in range(106)]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BOUNDS[min(i, len(BOUNDS) - 1)]
+        return BOUNDS[-1]
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.monotonic()
+        self.last_counters = {}
+        self.last_snapshot = self.started
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        # Rates cover the time since the previous snapshot, so a scraper polling every few seconds
+        # sees current fps and bitrate rather than session averages
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(now - self.last_snapshot, 1e-9)
+            stages = {
+                name: {
+                    "count": h.count,
+                    "mean_ms": round(1000 * h.total / max(h.count, 1), 3),
+                    "p50_ms": round(1000 * h.percentile(50), 3),
+                    "p99_ms": round(1000 * h.percentile(99), 3),
+                }
+                for name, h in self.histograms.items()
+            }
+            rates = {name: (value - self.last_counters.get(name, 0)) / elapsed for name, value in self.counters.items()}
+            counters = dict(self.counters)
+            self.last_counters = counters
+            self.last_snapshot = now
+        return {
+            "uptime_s": now - self.started,
+            "stages": stages,
+            "counters": counters,
+            "rates": rates,
+            "gauges": {name: read() for name, read in self.gauges.items()},
+        }
+
+    def text(self):
+        snapshot = self.snapshot()
+        lines = [f"uptime_seconds {snapshot['uptime_s']:.1f}"]
+        for name, stage in sorted(snapshot["stages"].items()):
+            for key, value in stage.items():
+                lines.append(f"{name}_{key} {value:.3f}" if isinstance(value, float) else f"{name}_{key} {value}")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name}_total {value}")
+        for name, value in sorted(snapshot["rates"].items()):
+            lines.append(f"{name}_per_second {value:.2f}")
+        for name, value in sorted(snapshot["gauges"].items()):
+            if isinstance(value, dict):
+                lines.extend(f'{name}{{key="{key}"}} {item}' for key, item in sorted(value.items()))
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class NullMetrics:
+    # Stands in when instrumentation is off so hot loops pay for a method call and nothing else
+    def record(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def gauge(self, name, read):
+        pass
+
+    def snapshot(self):
+        return {}
+
+    def text(self):
+        return ""
+
+
+def create_metrics(enabled):
+    return Metrics() if enabled else NullMetrics()
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    # GET /metrics for plain text, /metrics.json for the raw snapshot
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Only needed with a stats port
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics.json":
+                body, content_type = json.dumps(metrics.snapshot()).encode(), "application/json"
+            elif self.path in ("/", "/metrics"):
+                body, content_type = metrics.text().encode(), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Stats available at http://{host}:{port}/metrics")
+    return server
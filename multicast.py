@@ -0,0 +1,294 @@
+import asyncio
+import collections
+import os
+import socket
+import struct
+import threading
+import time
+import numpy as np
+import protocol
+
+# Frames sent once to a multicast group instead of once per subscriber, so the host's uplink carries
+# each frame once however many viewers are on the segment. A message's parts are joined and cut into
+# datagrams that fit an Ethernet MTU, followed by XOR parity: with P parity fragments, fragment i
+# belongs to group i % P, so up to P consecutive lost datagrams (a typical burst) are each the only
+# loss in their group and can be rebuilt. A message can only be rebuilt if every one of its groups
+# is, so big messages (keyframes) get smaller groups. Messages that still can't be completed are
+# given up; the viewer asks the host for a keyframe over the control channel, and falls back to a
+# snapshot over tcp when the keyframes don't make it either.
+MULTICAST_GROUP = "239.255.77.78"
+DATAGRAM_SIZE = 1400  # Stays under a 1500 byte MTU with IP and UDP headers
+FRAGMENT_SIZE = DATAGRAM_SIZE - protocol.DATAGRAM_HEADER.size
+FEC_TARGET = 0.05  # Odds of losing a whole message that parity groups are sized for
+LENGTH_DTYPE = np.dtype(">u4")
+COUNT = struct.Struct("!H")
+
+
+def join_parts(parts):
+    # Part count, part lengths, then the parts back to back
+    buffers = [memoryview(part.buffer if hasattr(part, "buffer") else part).cast("B") for part in parts]
+    lengths = np.array([len(buffer) for buffer in buffers], dtype=LENGTH_DTYPE)
+    return b"".join([COUNT.pack(len(buffers)), lengths.tobytes()] + buffers)
+
+
+def split_parts(body):
+    # Inverse of join_parts; parts are views into body. None when the lengths don't add up.
+    if len(body) < COUNT.size:
+        return None
+    count, = COUNT.unpack_from(body)
+    start = COUNT.size + count * LENGTH_DTYPE.itemsize
+    if len(body) < start:
+        return None
+    ends = start + np.cumsum(np.frombuffer(body, dtype=LENGTH_DTYPE, count=count, offset=COUNT.size), dtype=np.int64)
+    if count and ends[-1] != len(body):
+        return None
+    view = memoryview(body)
+    starts = [start] + ends[:-1].tolist()
+    return [view[begin:end] for begin, end in zip(starts, ends.tolist())]
+
+
+def group_size(data, largest, loss):
+    # Largest parity group, of at most largest data fragments, that keeps the odds of losing a message
+    # of data fragments under FEC_TARGET when that share of datagrams is dropped at random. A group is
+    # rebuilt as long as it loses at most one of its fragments, its parity included.
+    for size in range(largest, 1, -1):
+        fails = 1 - (1 - loss) ** (size + 1) - (size + 1) * loss * (1 - loss) ** size
+        if -(-data // size) * fails <= FEC_TARGET:
+            return size
+    return min(largest, 2)  # Beyond what XOR parity can repair; the viewer falls back to tcp
+
+
+class MulticastSender:
+    # Up to fec_group data fragments share one parity fragment, fewer in messages big enough that
+    # fec_loss would otherwise lose them too often; fec_group 0 sends no parity at all. loss drops
+    # that share of datagrams on purpose, so bench.py can measure what the parity recovers.
+    def __init__(self, group, port, fec_group=8, fec_loss=0.01, ttl=1, loss=0.0):
+        self.address = (group, port)
+        self.fec_group = fec_group
+        self.fec_loss = fec_loss
+        self.loss = loss
+        self.session = struct.unpack("!I", os.urandom(4))[0]  # Lets viewers notice a restarted host
+        self.seq = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)  # Viewers on the host too
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+        self.unreachable = False
+
+    def send(self, parts):
+        # Returns the number of datagrams sent
+        body = join_parts(parts)
+        data = -(-len(body) // FRAGMENT_SIZE)
+        parity = -(-data // group_size(data, self.fec_group, self.fec_loss)) if self.fec_group else 0
+        groups = max(parity, 1)
+        padded = np.zeros(-(-data // groups) * groups * FRAGMENT_SIZE, dtype=np.uint8)
+        padded[:len(body)] = np.frombuffer(body, dtype=np.uint8)
+        fragments = padded.reshape(-1, FRAGMENT_SIZE)
+        datagrams = [protocol.pack_datagram(self.session, self.seq, index, data, parity, len(body),
+                                            fragments[index, :len(body) - index * FRAGMENT_SIZE].tobytes())
+                     for index in range(data)]
+        if parity:
+            # Row r of the reshape holds fragments r * P .. r * P + P - 1, so column g is parity group g
+            xor = np.bitwise_xor.reduce(fragments.reshape(-1, parity, FRAGMENT_SIZE), axis=0)
+            datagrams += [protocol.pack_datagram(self.session, self.seq, data + group, data, parity, len(body),
+                                                 xor[group].tobytes()) for group in range(parity)]
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        if self.loss:
+            keep = np.random.random(len(datagrams)) >= self.loss
+            datagrams = [datagram for datagram, kept in zip(datagrams, keep) if kept]
+        for datagram in datagrams:
+            try:
+                self.socket.sendto(datagram, self.address)
+            except OSError as e:
+                if not self.unreachable:
+                    print(f"Multicast to {self.address[0]} failed: {e}")  # TCP viewers are unaffected
+                self.unreachable = True
+                return 0
+        self.unreachable = False
+        return len(datagrams)
+
+    def close(self):
+        self.socket.close()
+
+
+class PartialMessage:
+    def __init__(self, header):
+        self.data = header.data
+        self.parity = header.parity
+        self.length = header.length
+        self.fragments = {}
+
+    def add(self, header, fragment):
+        if header.data == self.data and header.parity == self.parity and header.length == self.length:
+            self.fragments.setdefault(header.index, bytes(fragment))
+
+    def missing(self):
+        return [index for index in range(self.data) if index not in self.fragments]
+
+    def complete(self):
+        # Returns (body, fragments rebuilt from parity), or None while that isn't possible yet
+        if len(self.fragments) < self.data:
+            return None
+        missing = self.missing()
+        if missing and not self.parity:
+            return None
+        recovered = 0
+        for index in missing:
+            group = index % self.parity
+            members = range(group, self.data, self.parity)
+            if self.data + group not in self.fragments or any(m != index and m not in self.fragments for m in members):
+                return None
+            rebuilt = np.frombuffer(self.fragments[self.data + group], dtype=np.uint8).copy()
+            for member in members:
+                if member != index:
+                    fragment = np.frombuffer(self.fragments[member], dtype=np.uint8)
+                    rebuilt[:len(fragment)] ^= fragment
+            self.fragments[index] = rebuilt[:min(FRAGMENT_SIZE, self.length - index * FRAGMENT_SIZE)].tobytes()
+            recovered += 1
+        return b"".join(self.fragments[index] for index in range(self.data)), recovered
+
+
+class Reassembler:
+    # Turns datagrams back into messages, in the order they were sent. A message still incomplete
+    # timeout seconds after a later one started arriving is given up and counted in lost, including
+    # the one half sent when the viewer joined: a viewer that hasn't completed any yet needs a keyframe.
+    def __init__(self, timeout=0.1, max_pending=64):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.session = None
+        self.next_seq = None
+        self.pending = {}
+        self.done = {}
+        self.waiting_since = None
+        self.recovered = 0
+        self.lost = 0
+
+    def add(self, datagram):
+        # Returns the messages this datagram completed, each as a list of parts
+        parsed = protocol.parse_datagram(datagram)
+        if parsed is None:
+            return []
+        header, fragment = parsed
+        if header.session != self.session:
+            self.session = header.session
+            self.next_seq = header.seq
+            self.pending.clear()
+            self.done.clear()
+            self.waiting_since = None
+        if header.seq < self.next_seq or header.seq in self.done:
+            return self.expire()
+        partial = self.pending.setdefault(header.seq, PartialMessage(header))
+        partial.add(header, fragment)
+        completed = partial.complete()
+        if completed is not None:
+            body, recovered = completed
+            self.recovered += recovered
+            del self.pending[header.seq]
+            self.done[header.seq] = body
+        return self.expire()
+
+    def expire(self):
+        # Delivers what is next in line and gives up on the head of the line once it has waited too long
+        messages = []
+        now = time.monotonic()
+        while self.next_seq is not None:
+            if self.next_seq in self.done:
+                parts = split_parts(self.done.pop(self.next_seq))
+                if parts is not None:
+                    messages.append(parts)
+            elif not (self.pending.keys() - {self.next_seq} or self.done):
+                self.waiting_since = None
+                break
+            elif self.waiting_since is None:
+                self.waiting_since = now
+                break
+            elif now - self.waiting_since < self.timeout and len(self.pending) < self.max_pending:
+                break
+            else:
+                self.pending.pop(self.next_seq, None)
+                self.lost += 1
+            self.next_seq += 1
+            self.waiting_since = None
+        return messages
+
+
+def listen_socket(group, port, receive_buffer=4 * 1024 * 1024):
+    # A keyframe arrives as hundreds of datagrams at once; the kernel may cap the buffer lower
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    listener.bind(("", port))
+    membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+    listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    listener.settimeout(0.05)
+    return listener
+
+
+class MulticastSubscriber:
+    # Stands in for a Client's SUB socket (async poll and recv_multipart, close). Datagrams are read and
+    # reassembled on a thread of its own, so a keyframe burst is drained while the loop decodes. The group
+    # carries every simulcast layer; messages whose first part doesn't start with topic are dropped here.
+    def __init__(self, group, port, metrics=None, topic=b""):
+        self.topic = topic
+        self.socket = listen_socket(group, port)
+        self.reassembler = Reassembler()
+        self.metrics = metrics
+        self.messages = collections.deque()
+        self.loop = None
+        self.arrived = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def lost(self):
+        return self.reassembler.lost
+
+    def run(self):
+        while self.running:
+            try:
+                datagram = self.socket.recv(65536)
+            except socket.timeout:
+                datagram = None
+            except OSError:
+                break
+            recovered = self.reassembler.recovered
+            messages = self.reassembler.add(datagram) if datagram else self.reassembler.expire()
+            if self.metrics:
+                self.metrics.count("datagrams_received", bool(datagram))
+                self.metrics.count("fec_recovered", self.reassembler.recovered - recovered)
+            messages = [parts for parts in messages if parts and bytes(parts[0][:len(self.topic)]) == self.topic]
+            if messages:
+                self.messages.extend(messages)
+                self.wake()
+        self.socket.close()
+
+    def wake(self):
+        try:
+            self.loop.call_soon_threadsafe(self.arrived.set)
+        except (AttributeError, RuntimeError):
+            pass  # Nobody polling yet, or the loop has already closed
+
+    async def poll(self, timeout=0):
+        # timeout in milliseconds, like zmq
+        if self.loop is None:
+            self.arrived = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
+        if not self.messages and timeout:
+            self.arrived.clear()
+            if not self.messages:
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), timeout / 1000)
+                except asyncio.TimeoutError:
+                    pass
+        return bool(self.messages)
+
+    async def recv_multipart(self, copy=True):
+        while not self.messages:
+            await self.poll(1000)
+        return self.messages.popleft()
+
+    def close(self, linger=None):
+        self.running = False
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import numpy as np
+import tiles
+
+# Encoding in worker processes for captures one process can't keep up with (4K, several monitors).
+# Frames go into a ring of shared memory slots, one per frame in flight; workers map the slot and
+# encode a band of it, so only slot names, shapes and rects are pickled on the way in and only the
+# compressed payloads on the way back.
+
+
+class EncoderPool:
+    def __init__(self, processes=None, slots=2, min_parallel_pixels=256 * 1024):
+        self.processes = processes or os.cpu_count()
+        self.min_parallel_pixels = min_parallel_pixels
+        # Spawned rather than forked everywhere: the server's zmq and capture threads must not be copied
+        self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+        self.segments = [None] * slots
+        self.broken = False  # A worker died; the executor takes no more work
+        # CPU seconds the workers spent encoding, which time.process_time() in the server doesn't see
+        self.cpu_time = 0.0
+        self.cpu_lock = threading.Lock()
+        self.close_lock = threading.Lock()
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        # Start every worker now so the first frames don't wait for processes to import cv2
+        for future in [self.executor.submit(_warm_up) for _ in range(self.processes)]:
+            future.result()
+
+    def encode(self, frame, rects, codec, quality, tile_size):
+        # Same result as DeltaEncoder.encode: (rects, payloads) in rect order
+        groups = split_work(rects, tile_size, self.processes)
+        if len(groups) < 2 or sum(w * h for _, _, w, h in rects) < self.min_parallel_pixels:
+            return _encode_rects(frame, rects, codec.name, quality, tile_size)
+        slot = self.free.get()  # Blocks when every slot is still being encoded
+        try:
+            segment = self.slot(slot, frame.nbytes)
+            np.ndarray(frame.shape, dtype=frame.dtype, buffer=segment.buf)[...] = frame
+            futures = [self.executor.submit(_encode_band, segment.name, frame.shape, group, codec.name, quality,
+                                            tile_size) for group in groups]
+            encoded_rects, payloads, cpu = [], [], 0.0
+            for future in futures:
+                band_rects, band_payloads, band_cpu = future.result()
+                encoded_rects += band_rects
+                payloads += band_payloads
+                cpu += band_cpu
+            with self.cpu_lock:
+                self.cpu_time += cpu
+            return encoded_rects, payloads
+        except BrokenProcessPool:
+            self.broken = True
+            raise
+        finally:
+            self.free.put(slot)
+
+    def slot(self, slot, size):
+        # Grows a slot when a bigger frame arrives, e.g. after switching to a larger monitor
+        segment = self.segments[slot]
+        if segment is None or segment.size < size:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+            segment = self.segments[slot] = shared_memory.SharedMemory(create=True, size=size)
+        return segment
+
+    def close(self):
+        # Safe to call again, or from several threads at once: each segment is unlinked exactly once
+        with self.close_lock:
+            segments, self.segments = self.segments, [None] * len(self.segments)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for segment in segments:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+
+
+def split_work(rects, tile_size, count):
+    # Cuts rects taller than a tile row into bands on the tile grid, then deals them out in order as
+    # count groups of about equal area
+    band_rows = max(1, -(-max((h for _, _, _, h in rects), default=0) // tile_size // count))
+    pieces = []
+    for x, y, w, h in rects:
+        for top in range(y, y + h, band_rows * tile_size):
+            pieces.append((x, top, w, min(band_rows * tile_size, y + h - top)))
+    total = sum(w * h for _, _, w, h in pieces)
+    groups, group, area = [], [], 0
+    for piece in pieces:
+        group.append(piece)
+        area += piece[2] * piece[3]
+        if area >= total * (len(groups) + 1) / count and len(groups) < count - 1:
+            groups.append(group)
+            group = []
+    if group:
+        groups.append(group)
+    return groups
+
+
+# Worker side. Segments stay mapped between jobs; only the last few are kept, since slots that grew
+# have been replaced.
+_segments = {}
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def _attach(name):
+    segment = _segments.get(name)
+    if segment is None:
+        while len(_segments) >= 8:
+            _segments.pop(next(iter(_segments))).close()
+        # Spawned workers share the server's resource tracker, so attaching here doesn't make the segment
+        # outlive or die with this worker; the server unlinks it
+        _segments[name] = segment = shared_memory.SharedMemory(name=name)
+    return segment
+
+
+def _encode_band(name, shape, rects, codec, quality, tile_size):
+    # Also returns the CPU seconds spent, for the server's cpu_budget
+    started = time.process_time()
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=_attach(name).buf)
+    rects, payloads = _encode_rects(frame, rects, codec, quality, tile_size)
+    return rects, [bytes(memoryview(payload)) for payload in payloads], time.process_time() - started
+
+
+def _encode_rects(frame, rects, codec, quality, tile_size):
+    encoder = tiles.DeltaEncoder(tile_size=tile_size, codec=codec, quality=quality)
+    return encoder.encode(frame, rects)
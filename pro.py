@@ -1,11 +1,56 @@
 import tkinter as tk
-from tkinter import simpledialog, messagebox
-import threading
-import pyautogui
-import cv2, os
-import numpy as np
-from PIL import Image, ImageTk, ImageDraw
-import psutil, socket, sys, pystray,zmq
+from tkinter import simpledialog
+import threading, queue, time, math
+import argparse, os
+import socket, sys
+from lazy import LazyModule
+from adaptive import FrameGovernor, QualityController, ReceiverStats, ViewerLag
+from metrics import create_metrics, serve_metrics
+from discovery import Beacon, find_streams, local_ip, new_stream_id
+
+# Imported on first use: the chooser needs none of these, the host no Tk imaging or asyncio
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
+zmq = LazyModule("zmq")
+zmq_asyncio = LazyModule("zmq.asyncio")
+asyncio = LazyModule("asyncio")
+Image = LazyModule("PIL.Image")
+ImageTk = LazyModule("PIL.ImageTk")
+ImageDraw = LazyModule("PIL.ImageDraw")
+tiles = LazyModule("tiles")
+protocol = LazyModule("protocol")
+cursor = LazyModule("cursor")
+multicast = LazyModule("multicast")
+# What each role ends up importing once it runs, for measuring startup (see bench.py --imports)
+ROLE_MODULES = {
+    "chooser": (),
+    "server": (cv2, np, zmq, Image, tiles, protocol),
+    "viewer": (cv2, np, zmq, zmq_asyncio, asyncio, Image, ImageTk, tiles, protocol),
+}
+
+CONTROL_PORT_OFFSET = 2
+SNAPSHOT_PORT_OFFSET = 3
+CURSOR_PORT_OFFSET = 4
+# What servers and relays announce in their discovery beacons
+STREAM_CAPS = {"snapshots": True, "control": True, "cursor": True}
+# Simulcast layers a server can publish, as (scale of the captured picture, JPEG quality, frame rate).
+# None follows the adaptive controller; full is what viewers, relays and recordings take by default.
+SIMULCAST_LAYERS = {
+    "full": (1.0, None, None),
+    "half": (0.5, 70, 15),
+    "thumb": (0.25, 60, 5),
+}
+DEFAULT_LAYER = "full"
+# Multicast keyframe requests left unanswered before a viewer fetches a snapshot over tcp instead
+MISSED_KEYFRAMES = 2
+
+
+def default_port(ip):
+    # Lab convention: .204 listens on 4444, .205 on 5555 and so on
+    digit = int(ip.split('.')[-1]) % 10
+    return int(f"{digit}{digit}{digit}{digit}")
+
+
 class ScreenShareApp(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -19,19 +64,23 @@ class ScreenShareApp(tk.Tk):
             bundle_dir = os.path.dirname(os.path.abspath(__file__))
         icon_path = os.path.join(bundle_dir, 'icon.ico')
         self.iconbitmap(icon_path)
-        self.geometry("200x350")
-        self.label = tk.Label(self, text="Choose an IP to Join")
+        self.geometry("260x420")
+        self.label = tk.Label(self, text="Looking for hosts...")
         self.label.pack(pady=10)
 
-        self.ip_listbox = tk.Listbox(self, selectmode=tk.SINGLE)
+        self.ip_listbox = tk.Listbox(self, selectmode=tk.SINGLE, width=36)
         self.ip_listbox.pack(pady=10)
-        ips = ["192.168.2.204", "192.168.2.205", "192.168.2.206", "192.168.2.207", "192.168.2.208"]
-        for ip in ips:
-            self.ip_listbox.insert(tk.END, ip)
         self.ip_listbox.bind("<Double-Button-1>", self.on_double_click)
+        self.streams = []
+        self.discovered = queue.Queue()
+        self.refresh_button = tk.Button(self, text="Refresh", command=self.refresh)
+        self.refresh_button.pack(pady=5)
         self.join_button = tk.Button(self, text="Join", command=self.run_client)
         self.join_button.pack(pady=10)
 
+        self.wall_button = tk.Button(self, text="Watch All", command=self.run_wall)
+        self.wall_button.pack(pady=10)
+
         self.server_button = tk.Button(self, text="Host", command=self.run_server)
         self.server_button.pack(pady=10)
 
@@ -40,42 +89,43 @@ class ScreenShareApp(tk.Tk):
         self.tray_icon = None
         self.client = None
         self.server = None
-        self.create_tray_icon()
-    def get_ethernet_ip(self):
-        interfaces = psutil.net_if_addrs()
-        for interface, addrs in interfaces.items():
-            if interface == 'Ethernet':
-                for addr in addrs:
-                    if addr.family == socket.AF_INET:
-                        return addr.address
-        return None
-    
-    def run_server(self):
-        ip_address = self.get_ethernet_ip()
-        if not ip_address:
-            messagebox.showerror("Error", "Could not find Ethernet adapter IP address")
+        self.refresh()
+
+    def refresh(self):
+        # Listening for beacons and probing take a couple of seconds, so they run off the Tk thread
+        self.label.config(text="Looking for hosts...")
+        self.refresh_button.config(state=tk.DISABLED)
+        threading.Thread(target=lambda: self.discovered.put(find_streams()), daemon=True).start()
+        self.after(100, self.show_streams)
+
+    def show_streams(self):
+        try:
+            self.streams = self.discovered.get_nowait()
+        except queue.Empty:
+            self.after(100, self.show_streams)
             return
+        self.ip_listbox.delete(0, tk.END)
+        for stream in self.streams:
+            via = " via relay" if stream["kind"] == "relay" else ""
+            self.ip_listbox.insert(tk.END, f"{stream['name']}{via}  {1000 * stream['rtt']:.1f} ms")
+        self.label.config(text="Choose a host to join" if self.streams else "No hosts found")
+        self.refresh_button.config(state=tk.NORMAL)
 
-        last_octet = int(ip_address.split('.')[-1])
-        port = int(f"{last_octet % 10}{last_octet % 10}{last_octet % 10}{last_octet % 10}")
-        port = simpledialog.askinteger("Port", "Enter port number:", initialvalue=port)
-        print(port)
+    def run_server(self):
+        port = simpledialog.askinteger("Port", "Enter port number:", initialvalue=default_port(local_ip()))
         if port:
             self.destroy()
-            server = Server(port)
-            server.start()
+            self.server = Server(port)
+            self.create_tray_icon()  # Only a host keeps running without a window to close
+            self.server.start()
 
     def run_client(self):
-        selected_ip = self.ip_listbox.get(tk.ACTIVE)
-        
-        if selected_ip:
-            last_octet = int(selected_ip.split('.')[-1])
-            port = int(f"{last_octet % 10}{last_octet % 10}{last_octet % 10}{last_octet % 10}")
-            port = simpledialog.askinteger("Port", "Enter port number:", initialvalue=port)
-            if(port == None):
-                return
+        selection = self.ip_listbox.curselection()
+
+        if selection:
+            stream = self.streams[selection[0]]
             self.destroy()
-            self.client = Client(selected_ip, port)
+            self.client = Client(stream["ip"], stream["port"])
             self.client.start()
         else:
             server_ip = simpledialog.askstring("Server IP", "Enter Server IP (use 'localhost' for local):")
@@ -88,26 +138,30 @@ class ScreenShareApp(tk.Tk):
                 self.destroy()
                 self.client = Client(server_ip, port)
                 self.client.start()
+    def run_wall(self):
+        self.destroy()
+        self.client = Wall([(stream["ip"], stream["port"], stream.get("caps", {}).get("layers", [DEFAULT_LAYER]))
+                            for stream in self.streams])
+        self.client.start()
+
     def on_double_click(self, event):
         self.run_client()
     def on_closing(self):
         self.close_all()
 
     def create_tray_icon(self):
+        import pystray  # Needs a desktop session, so only load it once hosting starts
+
         # Create an image for the tray icon
         image = Image.new('RGB', (64, 64), color='blue')
         draw = ImageDraw.Draw(image)
         draw.rectangle((0, 0, 64, 64), outline='blue', fill='blue')
 
         self.tray_icon = pystray.Icon("ScreenShareApp", image, "Screen Share App", menu=pystray.Menu(
-            pystray.MenuItem("Open", self.show_window),
-            pystray.MenuItem("Close", self.close_all)
+            pystray.MenuItem("Stop sharing", self.close_all)
         ))
         threading.Thread(target=self.tray_icon.run, daemon=True).start()
 
-    def show_window(self):
-        self.deiconify()
-
     def close_all(self, icon=None, item=None):
         if self.client:
             self.client.close()
@@ -115,47 +169,605 @@ class ScreenShareApp(tk.Tk):
             self.server.stop()
         if self.tray_icon:
             self.tray_icon.stop()
-        self.quit()
-        self.destroy()
+        try:
+            self.quit()
+            self.destroy()
+        except tk.TclError:
+            pass  # The chooser is already gone once a role has started
         sys.exit()
+def offset_endpoint(endpoint, offset):
+    # Side channels live next to the screen socket: tcp://host:port+offset or inproc://name-offset
+    if endpoint.startswith("inproc://"):
+        return f"{endpoint}-{offset}"
+    host, port = endpoint.rsplit(":", 1)
+    return f"{host}:{int(port) + offset}"
+
+
+def server_endpoint(address):
+    # host, host:port or a full zmq endpoint
+    if "://" in address:
+        return address
+    host, _, port = address.partition(":")
+    return f"tcp://{host}:{port or default_port(host)}"
+
+
+def decoder_report(seq, layer):
+    # Sent by subscribers that don't steer quality (wall hosts, recorders) so the host knows them: codec
+    # negotiation only picks a codec every reporting subscriber decodes
+    return {"type": "report", "viewer": f"{socket.gethostname()}:{os.getpid()}", "seq": seq,
+            "codecs": tiles.codec_names(), "layer": layer}
+
+
+def request_snapshot(context, endpoint, layer=DEFAULT_LAYER, timeout=1000):
+    # A fresh REQ socket per request, so a server that never answers can't wedge the REQ state machine.
+    # The request is the layer's topic.
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(offset_endpoint(endpoint, SNAPSHOT_PORT_OFFSET))
+    try:
+        socket.send(protocol.layer_topic(layer))
+        if not socket.poll(timeout):
+            return []
+        return protocol.unpack_snapshot(socket.recv_multipart(copy=False))
+    finally:
+        socket.close()
+
+
+def pick_reduction(encoded_width, shown_width):
+    # Decode at 1/2, 1/4 or 1/8 while the shown picture is at least that much smaller than the stream
+    reduction = 1
+    while reduction < 8 and encoded_width // (reduction * 2) >= shown_width:
+        reduction *= 2
+    return reduction
+
+
+_capture = threading.local()
+
+
+def grab_screen(region=None):
+    # Grabs only region, on any monitor and at negative coordinates too, with one mss instance per
+    # capturing thread since its handles can't be shared. Without mss pyautogui grabs the primary screen.
+    try:
+        import mss
+    except ImportError:
+        import pyautogui  # Fails to import without a display; headless benchmarks pass their own source
+        return np.array(pyautogui.screenshot(region=region))
+    sct = getattr(_capture, "sct", None)
+    if sct is None:
+        sct = _capture.sct = mss.mss()
+    if region is None:
+        area = sct.monitors[0]  # The whole virtual desktop, as monitor 0 of list_monitors
+    else:
+        area = dict(zip(("left", "top", "width", "height"), region))
+    return cv2.cvtColor(np.asarray(sct.grab(area)), cv2.COLOR_BGRA2RGB)
+
+
+def read_cursor():
+    # Default cursor source; cursor.py, and pyautogui behind it, load on the first call
+    return cursor.read_cursor()
+
+
+def list_monitors():
+    # (left, top, width, height) per monitor; index 0 is the whole virtual desktop like mss reports it
+    try:
+        import mss
+    except ImportError:
+        return [None]
+    with mss.mss() as sct:
+        return [(m["left"], m["top"], m["width"], m["height"]) for m in sct.monitors]
+
+
+class Layer:
+    # One simulcast layer of a Server: its own delta encoder, sequence numbers and late-joiner snapshot,
+    # published behind its own topic. dirty is set when the picture changes and cleared once a frame of
+    # the layer is queued, so layers running below the capture rate still pick up every change.
+    def __init__(self, name, encoder):
+        self.name = name
+        self.scale, self.quality, self.fps = SIMULCAST_LAYERS[name]
+        self.topic = protocol.layer_topic(name)
+        self.encoder = encoder
+        self.dirty = True
+        self.due = 0.0
+        self.seq = 0
+        self.next_send = 0
+        self.sent_seq = -1
+        self.keyframe_seq = -1
+        self.snapshot = []
+
+
 class Server:
-    def __init__(self, port):
+    def __init__(self, port, tile_size=64, keyframe_interval=2.0, encoder_workers=2, queue_size=2,
+                 source=grab_screen, context=None, endpoint=None,
+                 adaptive=True, quality=(40, 95), scale=(0.5, 1.0), fps=(5, 30), metrics=False, stats_port=None,
+                 max_snapshot_deltas=120, monitor=None, region=None, send_hwm=16, announce=True, idle_fps=1.0,
+                 cpu_budget=None, cursor_source=read_cursor, cursor_hz=60, codecs=("jpeg",), encode_processes=0,
+                 multicast_group=None, fec_group=8, fec_loss=0.01, layers=(DEFAULT_LAYER,), color=False):
         self.port = port
-        self.context = zmq.Context()
+        # Color sends YUV 4:2:0 (tiles.rgb_to_yuv420) in place of grayscale; viewers tell by the frame flag
+        self.color = color
+        unknown = [name for name in codecs if name not in tiles.CODECS]
+        if unknown:
+            raise ValueError(f"Unknown codecs {unknown}, this build has {tiles.codec_names()}")
+        # Tile codecs in order of preference; viewers report what they decode and the first one every
+        # viewer can handle is used
+        self.codecs = list(codecs)
+        self.viewer_codecs = {}
+        unknown = [name for name in layers if name not in SIMULCAST_LAYERS]
+        if unknown:
+            raise ValueError(f"Unknown layers {unknown}, choose from {list(SIMULCAST_LAYERS)}")
+        self.source = source
+        self.cursor_source = cursor_source
+        self.cursor_hz = cursor_hz
+        self.cursor_shapes = {}
+        self.region = None
+        self.set_region(monitor, region)
+        self.metrics = create_metrics(metrics or stats_port)
+        self.metrics.gauge("encode_queue_depth", lambda: self.encode_queue.qsize())
+        self.metrics.gauge("send_queue_depth", lambda: self.send_queue.qsize())
+        self.metrics.gauge("jpeg_quality", lambda: self.controller.quality)
+        self.metrics.gauge("scale", lambda: self.controller.scale)
+        self.metrics.gauge("target_fps", lambda: self.controller.fps)
+        self.metrics.gauge("idle", lambda: int(self.governor.idle))
+        self.metrics.gauge("cpu_cores", lambda: self.governor.cpu_cores)
+        self.metrics.gauge("codec", lambda: {self.encoder.codec.name: 1})
+        self.metrics.gauge("compression_ratio", self.compression_ratios)
+        self.viewer_lag = ViewerLag()
+        self.metrics.gauge("viewer_queue_depth", self.viewer_lag.depths)
+        if stats_port:
+            serve_metrics(self.metrics, stats_port)
+        self.controller = QualityController(quality=quality, scale=scale, fps=fps)
+        self.adaptive = adaptive
+        # Every layer is scaled from the same capture. The first one is driven by the adaptive controller
+        # and viewer reports; the others keep their own fixed quality and frame rate.
+        self.layers = []
+        for name in layers:
+            fixed_quality = SIMULCAST_LAYERS[name][1] if self.layers else None
+            encoder = tiles.DeltaEncoder(tile_size=tile_size, keyframe_interval=keyframe_interval,
+                                         codec=self.codecs[0], quality=fixed_quality or self.controller.quality)
+            self.layers.append(Layer(name, encoder))
+        self.layer_names = {layer.name: layer for layer in self.layers}
+        self.encoder = self.layers[0].encoder
+        self.encoder_workers = encoder_workers
+        # With encode_processes each encoder thread hands its frame to a pool of worker processes through
+        # shared memory instead of encoding it under this process's GIL
+        self.pool = None
+        self.retired_cpu = 0.0  # CPU time of a pool that broke, so the budget's clock never runs backwards
+        self.pool_lock = threading.Lock()  # Encoder threads that see the pool break race to retire it
+        if encode_processes:
+            from pool import EncoderPool
+            self.pool = EncoderPool(encode_processes, slots=encoder_workers)
+        self.governor = FrameGovernor(idle_fps=idle_fps, cpu_budget=cpu_budget, cpu_time=self.cpu_time)
+        self.encode_queue = queue.Queue(maxsize=queue_size * len(self.layers))
+        self.send_queue = queue.Queue()
+        self.dropped_frames = 0
+        # Each layer's latest keyframe followed by every delta sent since, replayed to clients that join
+        # mid-stream
+        self.snapshot_lock = threading.Lock()
+        self.max_snapshot_deltas = max_snapshot_deltas
+        self.own_context = context is None
+        self.context = context or zmq.Context()
+        self.endpoint = endpoint or f"tcp://*:{self.port}"
         self.screen_socket = self.context.socket(zmq.PUB)
-        self.screen_socket.bind(f"tcp://*:{self.port}")
+        # Bounded per-viewer queue: past it PUB drops whole messages for that viewer only, which shows up
+        # as a sequence gap and a snapshot resync instead of seconds of queued frames
+        self.screen_socket.setsockopt(zmq.SNDHWM, send_hwm)
+        self.screen_socket.bind(self.endpoint)
+        self.control_socket = self.context.socket(zmq.PULL)
+        self.control_socket.bind(offset_endpoint(self.endpoint, CONTROL_PORT_OFFSET))
+        self.snapshot_socket = self.context.socket(zmq.ROUTER)
+        self.snapshot_socket.bind(offset_endpoint(self.endpoint, SNAPSHOT_PORT_OFFSET))
+        # Pointer updates get their own connection so they never wait behind a large frame
+        self.cursor_socket = self.context.socket(zmq.PUB)
+        self.cursor_socket.setsockopt(zmq.SNDHWM, send_hwm)
+        self.cursor_socket.bind(offset_endpoint(self.endpoint, CURSOR_PORT_OFFSET))
+        # Optionally every frame also goes once to a multicast group on the screen port, for rooms full
+        # of viewers on one LAN; joining, control and the pointer stay on tcp
+        self.multicast = None
+        if multicast_group:
+            self.multicast = multicast.MulticastSender(multicast_group, self.port, fec_group=fec_group,
+                                                     fec_loss=fec_loss)
+        self.stream_id = new_stream_id()
+        caps = dict(STREAM_CAPS, codecs=self.codecs, layers=list(self.layer_names))
+        if multicast_group:
+            caps["multicast"] = multicast_group
+        self.beacon = Beacon(self.port, "server", self.stream_id, caps=caps) if announce else None
         self.running = False
         print(f"Server started on port {self.port}, waiting for connections...")
 
     def start(self):
-        screen_thread = threading.Thread(target=self.capture_screen)
-        screen_thread.start()
-        screen_thread.join()
+        self.running = True
+        if self.beacon:
+            self.beacon.start()
+        threads = [threading.Thread(target=self.capture_screen), threading.Thread(target=self.send_frames)]
+        threads += [threading.Thread(target=self.encode_frames) for _ in range(self.encoder_workers)]
+        threads.append(threading.Thread(target=self.receive_control))
+        threads.append(threading.Thread(target=self.serve_snapshots))
+        threads.append(threading.Thread(target=self.track_cursor))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.pool:
+            self.pool.close()
+
+    def track_cursor(self):
+        # Polls the pointer at cursor_hz and publishes every move at once, whatever the frame rate is.
+        # The shape goes along when it changes and once a second for viewers that joined since.
+        seq = 0
+        last = None
+        shape_sent = 0.0
+        while self.running and self.cursor_source is not None:
+            time.sleep(1.0 / self.cursor_hz)
+            try:
+                x, y, visible, shape = self.cursor_source()
+            except Exception as e:
+                print(f"Pointer tracking stopped: {e}")  # Frames keep going; viewers just see no pointer
+                break
+            left, top, width, height = self.region or (0, 0, None, None)
+            x, y = x - left, y - top
+            if x < 0 or y < 0 or (width is not None and (x >= width or y >= height)):
+                visible = False  # Pointer is outside the shared area
+            state = (x, y, visible, shape)
+            now = time.monotonic()
+            resend_shape = last is None or shape != last[3] or now - shape_sent >= 1.0
+            if state == last and not resend_shape:
+                continue
+            if shape not in self.cursor_shapes:
+                image, hotspot = cursor.cursor_image(shape)
+                self.cursor_shapes[shape] = (cv2.imencode(".png", image)[1], hotspot)
+            image, hotspot = self.cursor_shapes[shape]
+            if resend_shape:
+                shape_sent = now
+            message = protocol.pack_cursor(seq, time.time(), max(-32768, min(x, 32767)), max(-32768, min(y, 32767)),
+                                           visible, shape, hotspot, image if resend_shape else None)
+            try:
+                self.cursor_socket.send_multipart(message, copy=False)
+            except zmq.error.ContextTerminated:
+                break
+            self.metrics.count("cursor_updates")
+            seq += 1
+            last = state
+        self.cursor_socket.close(linger=0)
 
     def capture_screen(self):
-        while True:
-            screenshot = pyautogui.screenshot()
-            frame = np.array(screenshot)
-            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)  # Convert to grayscale
-            _, buffer = cv2.imencode('.jpg', gray_frame)
-            self.screen_socket.send(buffer.tobytes())
-            print(f"Sent frame of size: {len(buffer)}")
-            
+        next_capture = time.perf_counter()
+        while self.running:
+            delay = next_capture - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_capture = max(next_capture + self.governor.interval(self.controller.fps), time.perf_counter())
+
+            started = time.perf_counter()
+            frame = self.source(self.region)
+            captured = time.time()
+            converted = time.perf_counter()
+            self.metrics.record("capture", converted - started)
+            if self.color:
+                full_picture = tiles.rgb_to_yuv420(frame)
+                display_size = (full_picture.shape[1], full_picture.shape[0] * 2 // 3)
+            else:
+                full_picture = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)  # Convert to grayscale
+                display_size = (full_picture.shape[1], full_picture.shape[0])
+            changed = self.governor.changed(full_picture)
+            now = time.monotonic()
+            for layer in self.layers:
+                layer.dirty = layer.dirty or changed
+            layers = [layer for layer in self.layers
+                      if now >= layer.due and (layer.dirty or layer.encoder.keyframe_due())]
+            if not layers:
+                if not changed:
+                    # Same picture as last time: skip the resize, diff and encode, only keyframes keep going out
+                    self.metrics.count("frames_unchanged")
+                continue
+            # Each layer is scaled from the smallest picture already made that is at least its size
+            pictures = [(1.0, full_picture)]
+            scaled = []
+            for layer in layers:
+                scale = layer.scale * (self.controller.scale if layer is self.layers[0] else 1.0)
+                base_scale, picture = min((entry for entry in pictures if entry[0] >= scale),
+                                          key=lambda entry: entry[0])
+                if scale < base_scale:
+                    factor = scale / base_scale
+                    if self.color:
+                        picture = tiles.resize_yuv420(picture, factor)
+                    else:
+                        picture = cv2.resize(picture, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+                    pictures.append((scale, picture))
+                scaled.append((layer, picture))
+            diffed = time.perf_counter()
+            self.metrics.record("convert", diffed - converted)
+            for layer, picture in scaled:
+                if self.encode_queue.full():
+                    # Encoders are behind: drop this frame before diffing so the next delta is still
+                    # taken against the last frame that was actually sent; the layer stays dirty
+                    self.dropped_frames += 1
+                    self.metrics.count("frames_dropped")
+                    continue
+                layer.dirty = False
+                if layer.fps:
+                    layer.due = max(layer.due + 1.0 / layer.fps, now)
+                kind, rects = layer.encoder.diff(picture)
+                if not rects:
+                    continue  # Nothing changed since the layer's last frame
+                if kind == tiles.KEYFRAME:
+                    layer.keyframe_seq = layer.seq
+                self.encode_queue.put((layer, layer.seq, kind, picture, rects, captured, display_size))
+                layer.seq += 1
+            self.metrics.record("diff", time.perf_counter() - diffed)
+
+    def encode_frames(self):
+        while self.running:
+            try:
+                layer, seq, kind, frame, rects, captured, display_size = self.encode_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            height, width = frame.shape[:2]
+            encoder = layer.encoder
+            codec = encoder.codec
+            started = time.perf_counter()
+            try:
+                pool = self.pool
+                if pool:
+                    rects, payloads = pool.encode(frame, rects, codec, encoder.quality, encoder.tile_size)
+                else:
+                    rects, payloads = encoder.encode(frame, rects, codec)
+            except Exception as e:
+                self.encode_failed(layer, seq, e)
+                continue
+            elapsed = time.perf_counter() - started
+            self.metrics.record("encode", elapsed)
+            self.metrics.record(f"encode_{codec.name}", elapsed)
+            pixel_bytes = frame.nbytes // (width * height)
+            self.metrics.count(f"raw_bytes_{codec.name}", pixel_bytes * sum(rect[2] * rect[3] for rect in rects))
+            self.metrics.count(f"encoded_bytes_{codec.name}", sum(len(payload) for payload in payloads))
+            message = [layer.topic] + protocol.pack_frame(seq, captured, width, height, rects, payloads, kind,
+                                                          codec.id, display_size, self.color)
+            self.send_queue.put((layer, seq, message, captured, kind))
+
+    def cpu_time(self):
+        # CPU seconds of this process and its encoder processes, which together are held to cpu_budget
+        with self.pool_lock:
+            pool_cpu = self.retired_cpu + (self.pool.cpu_time if self.pool else 0.0)
+        return time.process_time() + pool_cpu
+
+    def encode_failed(self, layer, seq, error):
+        # The sender still waits for this seq, so it gets a tombstone to skip. Later deltas build on the
+        # lost one, so the layer starts over from a keyframe.
+        print(f"Failed to encode frame {seq} of layer {layer.name}: {error!r}")
+        self.metrics.count("encode_errors")
+        with self.pool_lock:
+            pool = self.pool
+            if pool is not None and pool.broken:
+                self.pool = None  # Only the first thread to get here retires it
+                self.retired_cpu += pool.cpu_time
+            else:
+                pool = None
+        if pool is not None:
+            print("Encoder processes died, encoding in this process from now on")
+            pool.close()
+        layer.encoder.force_keyframe()
+        self.send_queue.put((layer, seq, None, None, tiles.DELTA))
+
+    def send_frames(self):
+        # Workers finish out of order; each layer's deltas must go out in capture order. A message of None
+        # stands for a frame that failed to encode.
+        pending = {}
+        while self.running:
+            try:
+                layer, seq, message, captured, kind = self.send_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            pending[layer.name, seq] = (message, captured, kind)
+            try:
+                while (layer.name, layer.next_send) in pending:
+                    message, captured, kind = pending.pop((layer.name, layer.next_send))
+                    layer.next_send += 1
+                    if message is None:
+                        with self.snapshot_lock:
+                            layer.snapshot = []  # Deltas from here on can't be replayed until the keyframe
+                        continue
+                    started = time.perf_counter()
+                    self.screen_socket.send_multipart(message, copy=False)
+                    if self.multicast:
+                        self.metrics.count("datagrams_sent", self.multicast.send(message))
+                    self.metrics.record("send", time.perf_counter() - started)
+                    self.metrics.record("capture_to_send", time.time() - captured)
+                    self.metrics.count("frames_sent")
+                    self.metrics.count("bytes_sent", sum(len(part) for part in message))
+                    self.metrics.count(f"bytes_sent_{layer.name}", sum(len(part) for part in message))
+                    self.update_snapshot(layer, message, kind)
+                    layer.sent_seq = layer.next_send - 1
+            except zmq.error.ContextTerminated:
+                break
+        self.screen_socket.close(linger=0)
+        if self.multicast:
+            self.multicast.close()
+
+    def update_snapshot(self, layer, message, is_keyframe):
+        with self.snapshot_lock:
+            if is_keyframe:
+                layer.snapshot = [message]
+            elif layer.snapshot:
+                layer.snapshot.append(message)
+            if len(layer.snapshot) > self.max_snapshot_deltas:
+                layer.encoder.force_keyframe()  # Keep the replay for late joiners short
+
+    def serve_snapshots(self):
+        # Every joining client gets the same cached messages, so a classroom joining at once costs no encoding
+        while self.running:
+            try:
+                if not self.snapshot_socket.poll(500):
+                    continue
+                identity, _, topic = self.snapshot_socket.recv_multipart()
+                layer = next((layer for layer in self.layers if layer.topic == topic), self.layers[0])
+                with self.snapshot_lock:
+                    messages = list(layer.snapshot)
+                self.snapshot_socket.send_multipart([identity, b""] + protocol.pack_snapshot(messages), copy=False)
+                self.metrics.count("snapshots_served")
+            except zmq.error.ContextTerminated:
+                break
+        self.snapshot_socket.close(linger=0)
+
+    def set_region(self, monitor=None, region=None, relative=False):
+        # Monitor 0 or no region means the whole desktop; a new frame size forces a keyframe on its own.
+        # Relative regions come from viewers selecting inside the picture they are currently shown.
+        if monitor:
+            monitors = list_monitors()
+            if not isinstance(monitor, int) or not 0 < monitor < len(monitors):
+                print(f"No monitor {monitor}, keeping the current capture area")
+                return
+            region = monitors[monitor]
+        if region is not None:
+            left, top, width, height = (int(value) for value in region)  # ValueError unless four numbers
+            if width <= 0 or height <= 0:
+                print(f"Ignoring empty capture region {region}")
+                return
+            if relative and self.region:
+                left += self.region[0]
+                top += self.region[1]
+            region = (left, top, width, height)
+        self.region = region
+        print(f"Capturing {region if region else 'the whole desktop'}")
+
+    def receive_control(self):
+        # Control messages come from anyone on the LAN; a malformed one is reported and skipped
+        try:
+            while self.running:
+                try:
+                    if self.control_socket.poll(500):
+                        self.handle_control(self.control_socket.recv_json())
+                    if self.controller.adjust():
+                        self.encoder.quality = self.controller.quality
+                        print(f"Adapted stream: quality {self.controller.quality}, "
+                              f"scale {self.controller.scale:.2f}, {self.controller.fps:.0f} fps")
+                except zmq.error.ContextTerminated:
+                    break
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    print(f"Ignoring malformed control message: {e!r}")
+        finally:
+            self.control_socket.close(linger=0)
+
+    def handle_control(self, message):
+        kind = message.pop("type", None)
+        layer = self.layer_names.get(message.get("layer"), self.layers[0])
+        seq = message.get("seq")
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            seq = None  # Reports without one still steer quality; they just can't be placed in the queue
+        if kind == "report":
+            self.metrics.count("viewer_frames_dropped", int(message.get("dropped", 0)))
+            codecs = message.get("codecs", ["jpeg"])
+            if isinstance(message.get("viewer"), str) and seq is not None and isinstance(codecs, list):
+                self.viewer_lag.update(message["viewer"], seq, layer.sent_seq)
+                self.negotiate_codec(message["viewer"], [str(name) for name in codecs])
+            if self.adaptive and layer is self.layers[0]:
+                self.controller.add(message)  # Viewers of the fixed layers don't steer the stream
+        elif kind == "keyframe" and ((seq is not None and seq >= layer.keyframe_seq)
+                                     or time.monotonic() - layer.encoder.last_keyframe >= 0.5):
+            # A viewer fell behind and skipped its backlog, or lost a frame after the newest
+            # keyframe. Viewers that lost the same frame ask together; one keyframe answers them.
+            layer.encoder.force_keyframe()
+        elif kind == "region":
+            self.set_region(message.get("monitor"), message.get("region"), bool(message.get("relative", False)))
+
+    def negotiate_codec(self, viewer, codecs):
+        # Everyone gets the same stream, so it uses the first preferred codec that every viewer heard
+        # from in the last few seconds decodes, and JPEG, which all of them do, when there is none
+        now = time.monotonic()
+        self.viewer_codecs[viewer] = (set(codecs), now)
+        self.viewer_codecs = {viewer: entry for viewer, entry in self.viewer_codecs.items() if now - entry[1] < 5.0}
+        common = set.intersection(*(names for names, _ in self.viewer_codecs.values()))
+        name = next((name for name in self.codecs if name in common), "jpeg")
+        if name != self.encoder.codec.name:
+            for layer in self.layers:
+                layer.encoder.codec = tiles.CODECS[name]
+            print(f"Encoding tiles as {name}")
+
+    def compression_ratios(self):
+        # Raw pixel bytes per encoded byte, for every codec used so far
+        counters = dict(self.metrics.counters)
+        return {name: round(counters[f"raw_bytes_{name}"] / max(counters.get(f"encoded_bytes_{name}", 0), 1), 2)
+                for name in tiles.codec_names() if f"raw_bytes_{name}" in counters}
+
     def stop(self):
         self.running = False
-        self.context.term()
+        if self.beacon:
+            self.beacon.stop()
+        if self.own_context:
+            self.context.term()
         print("Server stopped")
+class LatestFrame:
+    # Single-slot mailbox: the decoder overwrites, the renderer only ever sees the newest frame
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = None
+
+    def put(self, frame):
+        with self.lock:
+            self.frame = frame
+
+    def take(self):
+        with self.lock:
+            frame, self.frame = self.frame, None
+        return frame
+
+
 class Client:
-    def __init__(self, server_ip, port):
+    def __init__(self, server_ip, port, headless=False, on_frame=None, context=None, endpoint=None,
+                 report_interval=1.0, render_hz=60, metrics=False, stats_port=None, zoom=1.0,
+                 delivery="latest", receive_hwm=4, codecs=None, multicast_group=None, layer=DEFAULT_LAYER):
         self.server_ip = server_ip
         self.port = port
-        self.context = zmq.Context()
-        self.screen_socket = self.context.socket(zmq.SUB)
-        self.screen_socket.connect(f"tcp://{self.server_ip}:{self.port}")
-        self.screen_socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        self.metrics = create_metrics(metrics or stats_port)
+        if stats_port:
+            serve_metrics(self.metrics, stats_port)
+        self.headless = headless
+        self.on_frame = on_frame
+        self.own_context = context is None
+        self.context = context or zmq.Context()
+        # Every socket lives on one asyncio loop in the receive thread; the Tk thread hands it work
+        self.async_context = zmq_asyncio.Context.shadow(self.context)
+        self.endpoint = endpoint or f"tcp://{self.server_ip}:{self.port}"
+        # "latest" decodes a backlog from its newest keyframe on and shows only its last frame;
+        # "reliable" shows every frame. Either way receive_hwm bounds how many frames can queue here.
+        self.delivery = delivery
+        self.receive_hwm = receive_hwm
+        # Tile codecs this viewer accepts, sent with every report; all registered ones unless restricted
+        self.codecs = list(codecs or tiles.codec_names())
+        # With a multicast group frames come from the host's datagrams instead of the SUB socket; lost
+        # ones are repaired by a keyframe request rather than a snapshot of this viewer's own
+        self.multicast_group = multicast_group
+        # Simulcast layer to show; only its frames leave the server for this viewer
+        self.layer = layer
+        self.topic = protocol.layer_topic(layer)
+        self.loop = None
+        self.keyframe_requested = None
+        self.keyframes_missed = 0  # Keyframe requests in a row that no keyframe answered
+        self.finished = threading.Event()
+        self.report_interval = report_interval
+        self.viewer_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.stats = ReceiverStats()
         self.running = False
+        self.screen = tiles.TileCanvas(cv2.IMREAD_GRAYSCALE)
+        self.sequence = protocol.SequenceTracker()
+        self.latest = LatestFrame()
+        # Newest pointer state as (x, y, visible, (shape id, image, hotspot)); the shape in use is kept
+        # on the receive loop until one with a new id arrives
+        self.cursor = LatestFrame()
+        self.cursor_shape = None
+        self.render_interval = max(1, int(1000 / render_hz))
+        # zoom is displayed pixels per shared pixel, None fits the picture to the window. view is the
+        # visible part of the canvas as (width, height, left, top), tracked on the Tk thread.
+        self.zoom = zoom
+        self.view = None
+        self.view_scale = 1.0
+        self.view_changed = False
+        self.needs_resync = False
+        self.screen_thread = None
         print(f"Connecting to server at {self.server_ip}:{self.port}")
+        if not headless:
+            self.create_window()
 
+    def create_window(self):
         self.root = tk.Tk()
         self.root.title("Shared Screen")
         self.root.attributes('-topmost', True)  # Make window stay on top
@@ -176,45 +788,341 @@ class Client:
         self.canvas.bind("<B1-Motion>", self.do_drag)
         self.canvas.bind_all("<MouseWheel>", self.on_mouse_wheel)
         self.canvas.bind_all("<Shift-MouseWheel>", self.on_shift_mouse_wheel)
+        # Ctrl+drag shares only the selected area, digit keys switch monitors (0 = whole desktop)
+        self.canvas.bind("<Control-ButtonPress-1>", self.start_select)
+        self.canvas.bind("<Control-B1-Motion>", self.do_select)
+        self.canvas.bind("<Control-ButtonRelease-1>", self.end_select)
+        self.root.bind("<Key>", self.on_key)
+        # Ctrl+wheel zooms, f fits the picture to the window, = goes back to 1:1
+        self.canvas.bind_all("<Control-MouseWheel>", self.on_ctrl_mouse_wheel)
 
         self.img_id = None
+        self.photo = None
+        self.cursor_id = None
+        self.cursor_photo = None
+        self.cursor_photo_shape = None
+        self.full_size = None
+        self.select_id = None
+        self.select_start = None
         self.drag_start_x = 0
         self.drag_start_y = 0
 
     def start(self):
         self.running = True
-        self.screen_thread = threading.Thread(target=self.receive_screen)
+        if self.headless:
+            asyncio.run(self.receive())
+            return
+        self.screen_thread = threading.Thread(target=asyncio.run, args=(self.receive(),))
         self.screen_thread.start()
+        self.root.after(self.render_interval, self.render)
         self.root.mainloop()
 
-    def receive_screen(self):
+    async def receive(self):
+        self.loop = asyncio.get_running_loop()
+        if self.multicast_group:
+            self.screen_socket = multicast.MulticastSubscriber(self.multicast_group, self.port, self.metrics,
+                                                               self.topic)
+        else:
+            self.screen_socket = self.async_context.socket(zmq.SUB)
+            self.screen_socket.setsockopt(zmq.RCVHWM, self.receive_hwm)
+            self.screen_socket.connect(self.endpoint)
+            self.screen_socket.setsockopt(zmq.SUBSCRIBE, self.topic)
+        # Reports and region changes share one PUSH socket to the server's control channel
+        self.control_socket = self.async_context.socket(zmq.PUSH)
+        self.control_socket.setsockopt(zmq.LINGER, 0)
+        self.control_socket.connect(offset_endpoint(self.endpoint, CONTROL_PORT_OFFSET))
+        self.cursor_socket = self.async_context.socket(zmq.SUB)
+        self.cursor_socket.connect(offset_endpoint(self.endpoint, CURSOR_PORT_OFFSET))
+        self.cursor_socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        tasks = [asyncio.ensure_future(self.send_reports()), asyncio.ensure_future(self.receive_cursor())]
+        try:
+            await self.receive_screen()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.screen_socket.close(linger=0)
+            self.control_socket.close(linger=0)
+            self.cursor_socket.close(linger=0)
+            self.finished.set()
+
+    async def receive_screen(self):
+        await self.resync()
+        given_up = 0
         while self.running:
             try:
-                buffer = self.screen_socket.recv()
-                if len(buffer) < 10:  # Arbitrary threshold to check for valid image data
-                    continue
-
-                frame = np.frombuffer(buffer, dtype=np.uint8)
-                frame = cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE)  # Decode as grayscale
-                if frame is not None:
-                    self.update_image(frame)
-                else:
-                    print("Failed to decode frame")
+                if await self.screen_socket.poll(50):
+                    batch = [await self.screen_socket.recv_multipart(copy=False)]
+                    if self.delivery == "latest":
+                        while await self.screen_socket.poll(0):
+                            batch.append(await self.screen_socket.recv_multipart(copy=False))
+                    if self.handle_batch(batch):
+                        self.repair()  # Frames went missing
+                if self.multicast_group and self.screen_socket.lost > given_up:
+                    given_up = self.screen_socket.lost  # Gave up on a message; don't wait for the next one
+                    self.repair()
+                elif self.view_changed and self.screen.buffer is not None:
+                    self.view_changed = False  # Scrolled or zoomed while the picture is static
+                    self.show(self.screen.header.timestamp)
+                if self.needs_resync:
+                    self.needs_resync = False
+                    await self.resync()
             except zmq.error.ContextTerminated:
                 break
             except Exception as e:
                 print(f"Failed to receive screen data: {e}")
 
-    def update_image(self, frame):
+    async def receive_cursor(self):
+        # Only the newest position of a backlog is shown, but every shape image in it is looked at
+        while self.running:
+            try:
+                if not await self.cursor_socket.poll(100):
+                    continue
+                latest = None
+                while await self.cursor_socket.poll(0):
+                    parsed = protocol.parse_cursor(await self.cursor_socket.recv_multipart())
+                    if parsed is None:
+                        continue
+                    latest, image = parsed
+                    if image is not None and (self.cursor_shape is None or self.cursor_shape[0] != latest.shape):
+                        shape = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+                        if shape is not None:
+                            shape = Image.fromarray(cv2.cvtColor(shape, cv2.COLOR_BGRA2RGBA))
+                            self.cursor_shape = (latest.shape, shape, (latest.hotspot_x, latest.hotspot_y))
+            except zmq.error.ContextTerminated:
+                break
+            if latest is None:
+                continue
+            self.metrics.record("cursor_delay", time.time() - latest.timestamp)
+            self.metrics.count("cursor_updates")
+            if self.cursor_shape is not None and self.cursor_shape[0] == latest.shape:
+                visible = bool(latest.flags & protocol.FLAG_CURSOR_VISIBLE)
+                self.cursor.put((latest.x, latest.y, visible, self.cursor_shape))
+
+    async def send_reports(self):
+        while self.running:
+            await asyncio.sleep(self.report_interval)
+            await self.send_report()
+
+    def handle_batch(self, batch):
+        # Returns the number of frames found missing. Frames before the newest keyframe of a backlog
+        # only advance the sequence; they are never decoded and count as dropped in the next report.
+        # A backlog that fills the receive queue without a keyframe is skipped the same way, and so is
+        # everything after it until the keyframe requested from the server arrives.
+        messages = [(protocol.parse_frame(parts), parts) for parts in batch]
+        keyframes = [i for i, (message, _) in enumerate(messages)
+                     if message and protocol.keyframe(message.header)]
+        if keyframes:
+            start = keyframes[-1]
+        elif self.keyframe_requested is not None and time.monotonic() - self.keyframe_requested < 1.0:
+            start = len(messages)
+        elif self.delivery == "latest" and len(messages) >= self.receive_hwm:
+            start = len(messages)
+            self.request_keyframe()
+        else:
+            start = 0
+        last = max([i for i, (message, _) in enumerate(messages) if message], default=-1)
+        lost = 0
+        for i, (message, parts) in enumerate(messages):
+            if message is None:
+                print("Discarding malformed frame")
+            elif i < start:
+                if self.sequence.accept(message.header):
+                    self.stats.dropped += 1
+                    self.metrics.count("frames_conflated")
+            else:
+                lost += self.handle_frame(parts, message, show=i == last)
+        return lost
+
+    def request_keyframe(self):
+        self.keyframe_requested = time.monotonic()
+        seq = -1 if self.sequence.expected is None else self.sequence.expected - 1
+        self.loop.create_task(self.send_control({"type": "keyframe", "layer": self.layer, "seq": seq}))
+
+    def repair(self):
+        # Over tcp this viewer fetches a snapshot of its own. Over multicast it sends a NACK instead: the
+        # keyframe it asks for goes to the whole group and repairs every viewer that lost the same datagrams.
+        # Loss too heavy for those keyframes to arrive whole either falls back to a snapshot after all.
+        if not self.multicast_group:
+            self.needs_resync = True
+        elif self.keyframe_requested is None or time.monotonic() - self.keyframe_requested >= 1.0:
+            self.keyframes_missed += self.keyframe_requested is not None
+            if self.keyframes_missed >= MISSED_KEYFRAMES:
+                self.keyframes_missed = 0
+                self.keyframe_requested = None
+                self.metrics.count("multicast_fallbacks")
+                self.needs_resync = True
+                return
+            self.metrics.count("keyframes_requested")
+            self.request_keyframe()
+
+    def handle_frame(self, parts, message=None, show=True):
+        # Returns the number of frames found missing before this one
+        started = time.perf_counter()
+        message = message or protocol.parse_frame(parts)
+        if message is None:
+            print("Discarding malformed frame")
+            return 0
+        lost = self.sequence.lost
+        if not self.sequence.accept(message.header):
+            return 0  # Stale frame arriving after a newer one
+        lost = self.sequence.lost - lost
+        self.stats.dropped += lost
+        self.metrics.count("frames_lost", lost)
+        size = sum(len(part) for part in parts)
+        self.metrics.count("frames_received")
+        self.metrics.count("bytes_received", size)
+
+        decoding = time.perf_counter()
+        self.metrics.record("parse", decoding - started)
+        if not self.screen.apply(message):
+            print("Waiting for keyframe")
+            return lost
+        if protocol.keyframe(message.header):
+            self.keyframe_requested = None
+            self.keyframes_missed = 0
+        decode_time = time.perf_counter() - decoding
+        self.metrics.record("decode", decode_time)
+        codec = tiles.CODECS.get(message.header.codec)
+        self.metrics.record(f"decode_{codec.name}", decode_time)
+        self.stats.frame(message.header.timestamp, decode_time)
+        if self.on_frame:
+            self.on_frame(message, size, decode_time)
+        if self.headless:
+            self.metrics.record("glass_to_glass", time.time() - message.header.timestamp)
+        elif show:
+            self.show(message.header.timestamp)
+        return lost
+
+    def show(self, captured):
+        prepared = self.prepare_image()
+        if prepared is not None:
+            self.latest.put(prepared + (captured,))
+
+    async def resync(self, timeout=1000):
+        # Same exchange as request_snapshot, awaited so the loop keeps serving the other sockets
+        socket = self.async_context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(offset_endpoint(self.endpoint, SNAPSHOT_PORT_OFFSET))
+        try:
+            await socket.send(self.topic)
+            messages = []
+            if await socket.poll(timeout):
+                messages = protocol.unpack_snapshot(await socket.recv_multipart(copy=False))
+        finally:
+            socket.close()
+        for i, parts in enumerate(messages):
+            self.handle_frame(parts, show=i == len(messages) - 1)  # Only the composite is worth displaying
+        self.metrics.count("snapshots_applied", bool(messages))
+
+    async def send_control(self, message):
+        try:
+            await self.control_socket.send_json(message, zmq.NOBLOCK)
+            return True
+        except zmq.Again:
+            return False
+
+    async def send_report(self):
+        seq = -1 if self.sequence.expected is None else self.sequence.expected - 1
+        # Not delivered when the server is unreachable; it keeps its current settings
+        await self.send_control({"type": "report", "viewer": self.viewer_id, "seq": seq, "codecs": self.codecs,
+                                 "layer": self.layer, **self.stats.report()})
+
+    async def send_region(self, message):
+        if not await self.send_control(message):
+            print("Server control channel not reachable")
+
+    def prepare_image(self):
+        # Runs on the decode thread. Only the visible part of the picture is scaled and converted, and
+        # the result is a private copy since the canvas buffer keeps being patched in place.
+        # Returns (image, offset on the canvas, full picture size) or None when nothing is visible.
+        started = time.perf_counter()
+        header = self.screen.header
+        window_width, window_height, left, top = self.view or (header.display_width, header.display_height, 0, 0)
+        scale = self.zoom or min(window_width / header.display_width, window_height / header.display_height)
+        full_width = max(1, round(header.display_width * scale))
+        full_height = max(1, round(header.display_height * scale))
+        self.view_scale = scale
+
+        reduction = pick_reduction(header.width, full_width)
+        if reduction != self.screen.reduction:
+            self.screen.set_reduction(reduction)
+            self.needs_resync = True
+            return None
+
+        left = min(max(int(left), 0), full_width)
+        top = min(max(int(top), 0), full_height)
+        right = min(full_width, left + window_width)
+        bottom = min(full_height, top + window_height)
+        if right <= left or bottom <= top:
+            return None
+        picture_height, picture_width = self.screen.picture_shape()
+        fx = picture_width / full_width
+        fy = picture_height / full_height
+        x, y = int(left * fx), int(top * fy)
+        crop = self.screen.picture(region=(x, y, max(math.ceil(right * fx), x + 1), max(math.ceil(bottom * fy), y + 1)))
+        size = (right - left, bottom - top)
+        if (crop.shape[1], crop.shape[0]) != size:
+            interpolation = cv2.INTER_AREA if fx > 1 else cv2.INTER_LINEAR
+            frame = cv2.resize(crop, size, interpolation=interpolation)
+        else:
+            frame = crop.copy()
         img = Image.fromarray(frame)
-        img_tk = ImageTk.PhotoImage(image=img)
+        self.metrics.record("prepare", time.perf_counter() - started)
+        return img, (left, top), (full_width, full_height)
+
+    def render(self):
+        if not self.running:
+            return
+        self.track_view()
+        latest = self.latest.take()
+        if latest is not None:
+            img, offset, full_size, captured = latest
+            started = time.perf_counter()
+            self.update_image(img, offset, full_size)
+            self.metrics.record("render", time.perf_counter() - started)
+            self.metrics.record("glass_to_glass", time.time() - captured)
+            self.metrics.count("frames_rendered")
+        pointer = self.cursor.take()
+        if pointer is not None:
+            self.update_cursor(*pointer)
+        self.root.after(self.render_interval, self.render)
+
+    def track_view(self):
+        view = (self.canvas.winfo_width(), self.canvas.winfo_height(),
+                self.canvas.canvasx(0), self.canvas.canvasy(0))
+        if view != self.view:
+            self.view = view
+            self.view_changed = True
 
-        self.canvas.config(scrollregion=self.canvas.bbox(tk.ALL))
-        if self.img_id is None:
-            self.img_id = self.canvas.create_image(0, 0, anchor='nw', image=img_tk)
+    def update_image(self, img, offset, full_size):
+        if full_size != self.full_size:
+            self.full_size = full_size
+            self.canvas.config(scrollregion=(0, 0) + full_size)
+
+        if self.photo is not None and (self.photo.width(), self.photo.height()) == img.size:
+            self.photo.paste(img)  # Reuse the Tk image instead of allocating a new one per frame
         else:
-            self.canvas.itemconfig(self.img_id, image=img_tk)
-        self.canvas.image = img_tk
+            self.photo = ImageTk.PhotoImage(image=img)
+            if self.img_id is None:
+                self.img_id = self.canvas.create_image(0, 0, anchor='nw', image=self.photo)
+            else:
+                self.canvas.itemconfig(self.img_id, image=self.photo)
+            self.canvas.image = self.photo
+        self.canvas.coords(self.img_id, *offset)
+
+    def update_cursor(self, x, y, visible, shape):
+        # The pointer is its own canvas item above the picture, so moving it never touches the frame
+        shape_id, image, (hotspot_x, hotspot_y) = shape
+        if shape_id != self.cursor_photo_shape:
+            self.cursor_photo = ImageTk.PhotoImage(image=image)
+            self.cursor_photo_shape = shape_id
+            if self.cursor_id is None:
+                self.cursor_id = self.canvas.create_image(0, 0, anchor='nw', image=self.cursor_photo)
+            else:
+                self.canvas.itemconfig(self.cursor_id, image=self.cursor_photo)
+        self.canvas.coords(self.cursor_id, x * self.view_scale - hotspot_x, y * self.view_scale - hotspot_y)
+        self.canvas.itemconfig(self.cursor_id, state='normal' if visible else 'hidden')
+        self.canvas.tag_raise(self.cursor_id)
 
     def start_drag(self, event):
         self.drag_start_x = event.x
@@ -234,14 +1142,397 @@ class Client:
     def on_shift_mouse_wheel(self, event):
         self.canvas.xview_scroll(-int(event.delta / 120), "units")
 
+    def on_ctrl_mouse_wheel(self, event):
+        factor = 2 if event.delta > 0 else 0.5
+        self.set_zoom(min(4.0, max(1 / 16, self.view_scale * factor)))
+
+    def set_zoom(self, zoom):
+        self.zoom = zoom
+        self.view_changed = True
+
+    def set_region(self, monitor=None, region=None, relative=False):
+        message = {"type": "region", "monitor": monitor, "region": region, "relative": relative}
+        if self.loop is None:
+            print("Not connected yet")
+            return
+        asyncio.run_coroutine_threadsafe(self.send_region(message), self.loop)
+
+    def on_key(self, event):
+        if event.char.isdigit():
+            self.set_region(monitor=int(event.char))
+        elif event.char == "f":
+            self.set_zoom(None)
+        elif event.char == "=":
+            self.set_zoom(1.0)
+
+    def start_select(self, event):
+        self.select_start = (self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+        x, y = self.select_start
+        self.select_id = self.canvas.create_rectangle(x, y, x, y, outline='red', width=2)
+
+    def do_select(self, event):
+        if self.select_id is not None:
+            x, y = self.select_start
+            self.canvas.coords(self.select_id, x, y, self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+
+    def end_select(self, event):
+        if self.select_id is None:
+            return
+        x0, y0, x1, y1 = (value / self.view_scale for value in self.canvas.coords(self.select_id))
+        self.canvas.delete(self.select_id)
+        self.select_id = None
+        left, top = int(min(x0, x1)), int(min(y0, y1))
+        width, height = int(abs(x1 - x0)), int(abs(y1 - y0))
+        if width > 8 and height > 8:
+            self.set_region(region=(max(left, 0), max(top, 0), width, height), relative=True)
+
     def close(self):
         self.running = False
-        self.context.term()
-        if self.screen_thread.is_alive():
+        if self.loop is not None:
+            self.finished.wait(2)  # Let the loop close its sockets before the context goes
+        if self.own_context:
+            self.context.term()
+        if self.screen_thread and self.screen_thread.is_alive():
             self.screen_thread.join()
+        if not self.headless:
+            self.root.quit()
+            self.root.destroy()
+
+class WallHost:
+    # One server on the wall; its socket and canvas belong to the wall's receive thread. The grid
+    # shows the smallest simulcast layer the host offers, the enlarged host its largest.
+    def __init__(self, name, endpoint, context, layers=(DEFAULT_LAYER,)):
+        self.name = name
+        self.endpoint = endpoint
+        self.socket = context.socket(zmq.SUB)
+        self.socket.connect(endpoint)
+        self.control_socket = context.socket(zmq.PUSH)
+        self.control_socket.setsockopt(zmq.LINGER, 0)
+        self.control_socket.connect(offset_endpoint(endpoint, CONTROL_PORT_OFFSET))
+        layers = sorted((name for name in layers if name in SIMULCAST_LAYERS),
+                        key=lambda name: SIMULCAST_LAYERS[name][0])
+        self.small_layer, self.large_layer = (layers[0], layers[-1]) if layers else (DEFAULT_LAYER, DEFAULT_LAYER)
+        self.layer = None
+        self.subscribe(self.small_layer)
+        self.reported = 0.0
+        self.latest = LatestFrame()
+        self.photo = None
+        self.img_id = None
+        self.label_id = None
+
+    def subscribe(self, layer):
+        # Switches layer; the new one is decoded from scratch, starting with a snapshot
+        if self.layer is not None:
+            self.socket.setsockopt(zmq.UNSUBSCRIBE, self.topic)
+        self.layer = layer
+        self.topic = protocol.layer_topic(layer)
+        self.socket.setsockopt(zmq.SUBSCRIBE, self.topic)
+        self.screen = tiles.TileCanvas(cv2.IMREAD_GRAYSCALE)
+        self.sequence = protocol.SequenceTracker()
+        self.needs_resync = True
+
+    def send_report(self, interval=1.0):
+        # At most once per interval; a host that isn't listening just doesn't hear it
+        now = time.monotonic()
+        if now - self.reported < interval:
+            return
+        self.reported = now
+        seq = -1 if self.sequence.expected is None else self.sequence.expected - 1
+        try:
+            self.control_socket.send_json(decoder_report(seq, self.layer), zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+
+class Wall:
+    # Mosaic of many servers in one process: a single Poller loop receives from every host and
+    # decodes at thumbnail size, clicking a cell shows that host alone at full window size
+    def __init__(self, hosts, context=None, render_hz=15, metrics=False, stats_port=None):
+        self.metrics = create_metrics(metrics or stats_port)
+        if stats_port:
+            serve_metrics(self.metrics, stats_port)
+        self.own_context = context is None
+        self.context = context or zmq.Context()
+        self.hosts = []
+        for host in hosts:
+            # An endpoint, or (ip, port) with the layers the host announces as an optional third item
+            if isinstance(host, str):
+                name, endpoint, layers = host, host, (DEFAULT_LAYER,)
+            else:
+                name, endpoint = host[0], f"tcp://{host[0]}:{host[1]}"
+                layers = host[2] if len(host) > 2 else (DEFAULT_LAYER,)
+            self.hosts.append(WallHost(name, endpoint, self.context, layers))
+        self.columns = max(1, math.ceil(math.sqrt(len(self.hosts))))
+        self.rows = max(1, math.ceil(len(self.hosts) / self.columns))
+        self.render_interval = max(1, int(1000 / render_hz))
+        # Both written on the Tk thread and read by the receive thread
+        self.focus = None
+        self.cell = (320, 180)
+        self.layout_changed = False
+        self.running = False
+        self.receive_thread = None
+        self.create_window()
+
+    def create_window(self):
+        self.root = tk.Tk()
+        self.root.title(f"Screen Wall ({len(self.hosts)} hosts)")
+        self.root.geometry(f"{self.columns * 320}x{self.rows * 180}")
+        self.canvas = tk.Canvas(self.root, bg='black', highlightthickness=0)
+        self.canvas.pack(fill='both', expand=True)
+        self.canvas.bind("<ButtonPress-1>", self.on_click)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        for host in self.hosts:
+            host.img_id = self.canvas.create_image(0, 0, anchor='nw')
+            host.label_id = self.canvas.create_text(4, 4, anchor='nw', text=host.name, fill='yellow')
+        self.size = None
+
+    def start(self):
+        self.running = True
+        self.receive_thread = threading.Thread(target=self.receive_screens)
+        self.receive_thread.start()
+        self.root.after(self.render_interval, self.render)
+        self.root.mainloop()
+
+    def receive_screens(self):
+        poller = zmq.Poller()
+        for host in self.hosts:
+            poller.register(host.socket, zmq.POLLIN)
+        sockets = {host.socket: host for host in self.hosts}
+        while self.running:
+            try:
+                for host in self.hosts:
+                    layer = host.large_layer if self.focus is host else host.small_layer
+                    if layer != host.layer:
+                        host.subscribe(layer)
+                    host.send_report()
+                self.resync([host for host in self.hosts if host.needs_resync and self.shown(host)])
+                ready = dict(poller.poll(50))
+                for sock in ready:
+                    host = sockets[sock]
+                    parts = sock.recv_multipart(copy=False)
+                    if self.shown(host):
+                        self.handle_frame(host, parts)
+                    else:
+                        # Hidden behind the enlarged host: skip the decode, catch up from a snapshot later
+                        host.needs_resync = True
+                        self.metrics.count("frames_skipped")
+                if self.layout_changed:
+                    self.layout_changed = False
+                    for host in self.hosts:
+                        if self.shown(host) and host.screen.buffer is not None:
+                            self.show(host)
+            except zmq.error.ContextTerminated:
+                break
+            except Exception as e:
+                print(f"Failed to receive screen data: {e}")
+        for host in self.hosts:
+            host.socket.close(linger=0)
+            host.control_socket.close(linger=0)
+
+    def shown(self, host):
+        return self.focus is None or self.focus is host
+
+    def resync(self, hosts, timeout=1000):
+        # Ask every host for its snapshot at once and take the replies as they come in, so one
+        # unreachable station costs a single timeout rather than one per host
+        if not hosts:
+            return
+        poller = zmq.Poller()
+        pending = {}
+        sockets = []
+        for host in hosts:
+            host.needs_resync = False
+            sock = self.context.socket(zmq.REQ)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(offset_endpoint(host.endpoint, SNAPSHOT_PORT_OFFSET))
+            sock.send(host.topic)
+            sockets.append(sock)
+            poller.register(sock, zmq.POLLIN)
+            pending[sock] = host
+        deadline = time.monotonic() + timeout / 1000
+        try:
+            while pending and time.monotonic() < deadline:
+                for sock, _ in poller.poll(max(1, int(1000 * (deadline - time.monotonic())))):
+                    host = pending.pop(sock)
+                    poller.unregister(sock)
+                    for parts in protocol.unpack_snapshot(sock.recv_multipart(copy=False)):
+                        self.handle_frame(host, parts, show=False)
+                    if host.screen.buffer is not None:
+                        self.show(host)  # Once, for the composite of the whole replay
+                    self.metrics.count("snapshots_applied")
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    def handle_frame(self, host, parts, show=True):
+        if bytes(parts[0]) != host.topic:
+            return  # Queued before the host switched layers
+        message = protocol.parse_frame(parts)
+        if message is None:
+            return
+        lost = host.sequence.lost
+        if not host.sequence.accept(message.header):
+            return
+        if host.sequence.lost > lost:
+            self.metrics.count("frames_lost", host.sequence.lost - lost)
+            host.needs_resync = True
+        self.metrics.count("frames_received")
+        decoding = time.perf_counter()
+        if host.screen.apply(message):
+            self.metrics.record("decode", time.perf_counter() - decoding)
+            if show:
+                self.show(host)
+
+    def show(self, host):
+        # Fits the host's picture into its cell, decoding only as much resolution as the cell can show
+        header = host.screen.header
+        width, height = self.cell
+        scale = min(width / header.display_width, height / header.display_height)
+        size = (max(1, round(header.display_width * scale)), max(1, round(header.display_height * scale)))
+        reduction = pick_reduction(header.width, size[0])
+        if reduction != host.screen.reduction:
+            host.screen.set_reduction(reduction)
+            host.needs_resync = True
+            return
+        buffer = host.screen.picture()
+        if (buffer.shape[1], buffer.shape[0]) != size:
+            interpolation = cv2.INTER_AREA if buffer.shape[1] > size[0] else cv2.INTER_LINEAR
+            frame = cv2.resize(buffer, size, interpolation=interpolation)
+        else:
+            frame = buffer.copy()
+        host.latest.put(Image.fromarray(frame))
+
+    def layout(self):
+        size = (max(1, self.canvas.winfo_width()), max(1, self.canvas.winfo_height()))
+        if size == self.size:
+            return
+        self.size = size
+        if self.focus is None:
+            self.cell = (max(1, size[0] // self.columns), max(1, size[1] // self.rows))
+        else:
+            self.cell = size
+        for index, host in enumerate(self.hosts):
+            x, y = self.position(index)
+            visible = self.shown(host)
+            self.canvas.coords(host.img_id, x, y)
+            self.canvas.coords(host.label_id, x + 4, y + 4)
+            self.canvas.itemconfig(host.img_id, state='normal' if visible else 'hidden')
+            self.canvas.itemconfig(host.label_id, state='normal' if visible else 'hidden')
+        self.layout_changed = True
+
+    def position(self, index):
+        if self.focus is not None:
+            return 0, 0
+        return (index % self.columns) * self.cell[0], (index // self.columns) * self.cell[1]
+
+    def render(self):
+        if not self.running:
+            return
+        self.layout()
+        for host in self.hosts:
+            img = host.latest.take()
+            if img is None or not self.shown(host):
+                continue
+            if host.photo is not None and (host.photo.width(), host.photo.height()) == img.size:
+                host.photo.paste(img)
+            else:
+                host.photo = ImageTk.PhotoImage(image=img)
+                self.canvas.itemconfig(host.img_id, image=host.photo)
+            self.metrics.count("frames_rendered")
+        self.root.after(self.render_interval, self.render)
+
+    def on_click(self, event):
+        if self.focus is not None:
+            self.focus = None
+        else:
+            column = min(event.x // self.cell[0], self.columns - 1)
+            index = (event.y // self.cell[1]) * self.columns + column
+            if index >= len(self.hosts):
+                return
+            self.focus = self.hosts[index]
+        self.size = None  # Relayout on the next render
+
+    def close(self):
+        self.running = False
+        if self.receive_thread and self.receive_thread.is_alive():
+            self.receive_thread.join()
+        if self.own_context:
+            self.context.term()
         self.root.quit()
         self.root.destroy()
 
+
+def multicast_group(group):
+    # --multicast on its own means the default group
+    if group is None:
+        return None
+    return group or multicast.MULTICAST_GROUP
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share this screen on the LAN or watch one")
+    roles = parser.add_subparsers(dest="role", help="Start straight in a role instead of the chooser window")
+    host = roles.add_parser("server", help="Share this screen")
+    host.add_argument("--port", type=int, help="Defaults to the lab port for this machine's address")
+    host.add_argument("--monitor", type=int, help="Share one monitor, numbered from 1")
+    host.add_argument("--fps", type=int, default=30, help="Frame rate while the picture is changing")
+    host.add_argument("--idle-fps", type=float, default=1.0, help="Frame rate once the picture has been still")
+    host.add_argument("--cpu-budget", type=float, help="Cores the host may use, e.g. 0.5")
+    host.add_argument("--codec", action="append", dest="codecs",
+                      help="Tile codec, repeat in order of preference (default jpeg); see bench.py --codec")
+    host.add_argument("--processes", type=int, default=0,
+                      help="Encode in this many worker processes, for 4K and multi-monitor captures")
+    host.add_argument("--multicast", nargs="?", const="", metavar="GROUP",
+                      help="Also send frames once to a multicast group, for many viewers on one LAN")
+    host.add_argument("--fec-loss", type=float, default=0.01,
+                      help="Multicast datagram loss the parity is sized for, e.g. 0.02 on busy Wi-Fi")
+    host.add_argument("--layers", nargs="+", choices=list(SIMULCAST_LAYERS), default=[DEFAULT_LAYER],
+                      help="Simulcast layers to publish, e.g. full half thumb; the first adapts to its viewers")
+    host.add_argument("--color", action="store_true",
+                      help="Send color (YUV 4:2:0) instead of grayscale; up to 45%% more bandwidth on noisy pictures")
+    host.add_argument("--stats-port", type=int)
+    viewer = roles.add_parser("viewer", help="Watch a host")
+    viewer.add_argument("host", nargs="?", help="host[:port]; the closest announced stream when left out")
+    viewer.add_argument("--codec", action="append", dest="codecs", help="Only accept these tile codecs")
+    viewer.add_argument("--multicast", nargs="?", const="", metavar="GROUP",
+                        help="Take frames from the host's multicast group instead of tcp")
+    viewer.add_argument("--layer", choices=list(SIMULCAST_LAYERS), default=DEFAULT_LAYER,
+                        help="Simulcast layer to watch, if the host publishes it")
+    viewer.add_argument("--stats-port", type=int)
+    args = parser.parse_args(argv)
+
+    if args.role == "server":
+        server = Server(args.port or default_port(local_ip()), fps=(min(5, args.fps), args.fps), monitor=args.monitor,
+                        stats_port=args.stats_port, idle_fps=args.idle_fps, cpu_budget=args.cpu_budget,
+                        codecs=args.codecs or ("jpeg",), encode_processes=args.processes,
+                        multicast_group=multicast_group(args.multicast), fec_loss=args.fec_loss,
+                        layers=args.layers, color=args.color)
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            server.stop()
+    elif args.role == "viewer":
+        announced = {}
+        if args.host:
+            host, _, port = args.host.partition(":")
+            ip = socket.gethostbyname(host)
+            port = int(port) if port else default_port(ip)
+        else:
+            streams = find_streams()
+            if not streams:
+                sys.exit("No hosts found; give one as host[:port]")
+            ip, port = streams[0]["ip"], streams[0]["port"]
+            announced = streams[0].get("caps", {})
+        group = args.multicast
+        if group == "":
+            group = announced.get("multicast", "")  # The group the host announced, else the default
+        Client(ip, port, stats_port=args.stats_port, codecs=args.codecs,
+               multicast_group=multicast_group(group), layer=args.layer).start()
+    else:
+        ScreenShareApp().mainloop()
+
+
 if __name__ == "__main__":
-    app = ScreenShareApp()
-    app.mainloop()
+    import multiprocessing
+    multiprocessing.freeze_support()  # Lets the frozen exe start encoder pool workers
+    main()
@@ -6,7 +6,9 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('icon.ico', '.')],
-    hiddenimports=[],
+    # pro.py imports these through LazyModule, which the dependency scan can't follow
+    hiddenimports=['cv2', 'numpy', 'zmq', 'zmq.asyncio', 'asyncio', 'PIL.Image', 'PIL.ImageTk', 'PIL.ImageDraw',
+                   'tiles', 'protocol', 'cursor', 'multicast', 'pyautogui', 'pystray', 'mss'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -16,17 +18,18 @@ a = Analysis(
 )
 pyz = PYZ(a.pure)
 
+# One folder rather than one file: a onefile exe unpacks every library to a temp directory on each
+# launch before any Python runs, and UPX-packed DLLs are decompressed on every load as well
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.datas,
     [],
+    exclude_binaries=True,
     name='pro',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
+    upx=False,
     upx_exclude=[],
     runtime_tmpdir=None,
     console=False,
@@ -37,3 +40,12 @@ exe = EXE(
     entitlements_file=None,
     icon=['icon.ico'],
 )
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='pro',
+)
@@ -0,0 +1,177 @@
+import struct
+from collections import namedtuple
+import numpy as np
+
+# Screen messages are multipart: [topic, header, rects, payload, payload, ...]
+#   topic   - layer_topic() of the simulcast layer, so PUB sockets filter layers per subscriber
+#   header  - HEADER below
+#   rects   - tile count * (x, y, w, h) as big-endian uint16, one per payload; hybrid frames add a fifth
+#             column, the codec id of each tile, so payloads go out as the inner codec produced them
+#   payload - encoded tile, sent straight from the encoder's buffer without copying
+VERSION = 1
+HEADER = struct.Struct("!BBBBIdHHHHH")  # version, kind, flags, codec, seq, timestamp, size, display size, tiles
+AUDIO_HEADER = struct.Struct("!BBBBIdIH")  # version, kind, codec, channels, seq, timestamp, rate, samples
+# version, kind, flags, reserved, seq, timestamp, position, shape id, hotspot
+CURSOR_HEADER = struct.Struct("!BBBBIdhhQHH")
+# version, kind, sender session, message seq, fragment index, data fragments, parity fragments, message length
+DATAGRAM_HEADER = struct.Struct("!BBIIHHHI")
+RECT_DTYPE = np.dtype(">u2")
+
+LAYER_PREFIX = b"layer/"
+KIND_FRAME = ord("F")
+KIND_AUDIO = ord("A")
+KIND_CURSOR = ord("C")
+KIND_DATAGRAM = ord("D")
+FLAG_KEYFRAME = 0x01
+FLAG_YUV420 = 0x02  # Color frame in the layout of tiles.rgb_to_yuv420; width and height are the packed size
+FLAG_CURSOR_VISIBLE = 0x01
+CODEC_JPEG = 1
+CODEC_PNG = 2
+CODEC_WEBP = 3
+CODEC_ZLIB = 4
+CODEC_LZ4 = 5
+CODEC_PALETTE = 6
+CODEC_HYBRID = 7
+
+Header = namedtuple("Header", "version kind flags codec seq timestamp width height display_width display_height tiles")
+Message = namedtuple("Message", "header rects payloads codecs")  # codecs: per tile ids, None unless hybrid
+AudioHeader = namedtuple("AudioHeader", "version kind codec channels seq timestamp rate samples")
+CursorHeader = namedtuple("CursorHeader", "version kind flags reserved seq timestamp x y shape hotspot_x hotspot_y")
+DatagramHeader = namedtuple("DatagramHeader", "version kind session seq index data parity length")
+
+
+def layer_topic(name):
+    # The trailing slash keeps one layer's topic from being a prefix of another's
+    return LAYER_PREFIX + name.encode() + b"/"
+
+
+def layer_name(topic):
+    return bytes(topic[len(LAYER_PREFIX):-1]).decode()
+
+
+def keyframe(header):
+    return bool(header.flags & FLAG_KEYFRAME)
+
+
+def pack_frame(seq, timestamp, width, height, rects, payloads, is_keyframe, codec=CODEC_JPEG, display_size=None,
+               color=False):
+    display_width, display_height = display_size or (width, height)
+    flags = (FLAG_KEYFRAME if is_keyframe else 0) | (FLAG_YUV420 if color else 0)
+    header = HEADER.pack(VERSION, KIND_FRAME, flags, codec, seq, timestamp,
+                         width, height, display_width, display_height, len(rects))
+    return [header, np.asarray(rects, dtype=RECT_DTYPE).tobytes()] + list(payloads)
+
+
+def parse_frame(parts):
+    # Accepts bytes or zmq.Frame parts, with or without the topic; payloads stay views into the received
+    # buffers. Returns None for anything that is not a well-formed frame of this version.
+    if parts and bytes(_buffer(parts[0])[:len(LAYER_PREFIX)]) == LAYER_PREFIX:
+        parts = parts[1:]
+    if len(parts) < 2:
+        return None
+    head = _buffer(parts[0])
+    if len(head) != HEADER.size:
+        return None
+    header = Header(*HEADER.unpack(head))
+    if header.version != VERSION or header.kind != KIND_FRAME or len(parts) != header.tiles + 2:
+        return None
+    columns = 5 if header.codec == CODEC_HYBRID else 4
+    rects = np.frombuffer(_buffer(parts[1]), dtype=RECT_DTYPE)
+    if len(rects) != header.tiles * columns:
+        return None
+    rects = rects.reshape(-1, columns).astype(np.intp)
+    return Message(header, rects[:, :4], [_buffer(part) for part in parts[2:]], rects[:, 4] if columns == 5 else None)
+
+
+def pack_audio(seq, timestamp, codec, channels, rate, samples, payload):
+    # Audio messages are [header, payload]; timestamp is when the chunk's first sample was captured
+    return [AUDIO_HEADER.pack(VERSION, KIND_AUDIO, codec, channels, seq, timestamp, rate, samples), payload]
+
+
+def parse_audio(parts):
+    # Returns (AudioHeader, payload) or None
+    if len(parts) != 2:
+        return None
+    head = _buffer(parts[0])
+    if len(head) != AUDIO_HEADER.size:
+        return None
+    header = AudioHeader(*AUDIO_HEADER.unpack(head))
+    if header.version != VERSION or header.kind != KIND_AUDIO:
+        return None
+    return header, _buffer(parts[1])
+
+
+def pack_cursor(seq, timestamp, x, y, visible, shape, hotspot, image=None):
+    # Cursor messages are [header] or, when they carry the shape, [header, PNG with alpha]. x and y are
+    # in shared-picture pixels before any scaling, so viewers place the pointer the way they place tiles.
+    header = CURSOR_HEADER.pack(VERSION, KIND_CURSOR, FLAG_CURSOR_VISIBLE if visible else 0, 0, seq, timestamp,
+                                x, y, shape, *hotspot)
+    return [header] if image is None else [header, image]
+
+
+def parse_cursor(parts):
+    # Returns (CursorHeader, shape image or None) or None
+    if len(parts) not in (1, 2):
+        return None
+    head = _buffer(parts[0])
+    if len(head) != CURSOR_HEADER.size:
+        return None
+    header = CursorHeader(*CURSOR_HEADER.unpack(head))
+    if header.version != VERSION or header.kind != KIND_CURSOR:
+        return None
+    return header, _buffer(parts[1]) if len(parts) == 2 else None
+
+
+def pack_datagram(session, seq, index, data, parity, length, fragment):
+    # One UDP datagram of a message split for multicast (see multicast.py): fragments below data carry
+    # the message, the rest XOR parity
+    return DATAGRAM_HEADER.pack(VERSION, KIND_DATAGRAM, session, seq, index, data, parity, length) + fragment
+
+
+def parse_datagram(datagram):
+    # Returns (DatagramHeader, fragment) or None
+    if len(datagram) < DATAGRAM_HEADER.size:
+        return None
+    header = DatagramHeader(*DATAGRAM_HEADER.unpack_from(datagram))
+    if header.version != VERSION or header.kind != KIND_DATAGRAM or header.index >= header.data + header.parity:
+        return None
+    return header, memoryview(datagram)[DATAGRAM_HEADER.size:]
+
+
+def _buffer(part):
+    return part.buffer if hasattr(part, "buffer") else memoryview(part)
+
+
+class SequenceTracker:
+    # Detects lost frames and rejects stale ones; keyframes always resynchronise (e.g. after a server restart)
+    def __init__(self):
+        self.expected = None
+        self.lost = 0
+
+    def accept(self, header):
+        if keyframe(header) or self.expected is None:
+            if self.expected is not None and header.seq > self.expected:
+                self.lost += header.seq - self.expected
+            self.expected = header.seq + 1
+            return True
+        if header.seq < self.expected:
+            return False  # Duplicate or out of order
+        self.lost += header.seq - self.expected
+        self.expected = header.seq + 1
+        return True
+
+
+def pack_snapshot(messages):
+    # Several frame messages in one reply: a part-count table, then every message's parts in order
+    counts = np.array([len(message) for message in messages], dtype=RECT_DTYPE).tobytes()
+    return [counts] + [part for message in messages for part in message]
+
+
+def unpack_snapshot(parts):
+    counts = np.frombuffer(_buffer(parts[0]), dtype=RECT_DTYPE).tolist()
+    messages = []
+    start = 1
+    for count in counts:
+        messages.append(parts[start:start + count])
+        start += count
+    return messages
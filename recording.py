@@ -0,0 +1,269 @@
+import argparse
+import mmap
+import os
+import struct
+import time
+import cv2
+import numpy as np
+import zmq
+from pro import (CONTROL_PORT_OFFSET, DEFAULT_LAYER, SIMULCAST_LAYERS, decoder_report, offset_endpoint,
+                 request_snapshot, server_endpoint)
+from protocol import SequenceTracker, keyframe, layer_topic, parse_frame
+from tiles import TileCanvas
+
+# A recording is two append-only files:
+#   <name>      MAGIC, then one record per frame message exactly as it came off the wire:
+#               RECORD (body length, part count), part lengths as big-endian uint32, the parts
+#   <name>.idx  MAGIC, then one INDEX_DTYPE entry per keyframe pointing at its record
+# Every keyframe starts a segment that decodes on its own, so seeking is a binary search over the
+# index followed by decoding at most one segment.
+MAGIC = b"SSREC001"
+RECORD = struct.Struct("!IH")
+LENGTH_DTYPE = np.dtype(">u4")
+INDEX_DTYPE = np.dtype([("timestamp", ">f8"), ("offset", ">u8"), ("seq", ">u4")])
+
+
+class Recorder:
+    # Subscribes like a Client and appends the encoded frames untouched, so the host does no extra work
+    def __init__(self, server_ip, port, path, context=None, endpoint=None, layer=DEFAULT_LAYER):
+        self.path = path
+        self.layer = layer
+        self.own_context = context is None
+        self.context = context or zmq.Context()
+        self.endpoint = endpoint or f"tcp://{server_ip}:{port}"
+        self.screen_socket = self.context.socket(zmq.SUB)
+        self.screen_socket.connect(self.endpoint)
+        self.screen_socket.setsockopt(zmq.SUBSCRIBE, layer_topic(layer))
+        self.control_socket = self.context.socket(zmq.PUSH)
+        self.control_socket.setsockopt(zmq.LINGER, 0)
+        self.control_socket.connect(offset_endpoint(self.endpoint, CONTROL_PORT_OFFSET))
+        self.keyframe_requested = None
+        self.reported = 0.0
+        self.sequence = SequenceTracker()
+        self.data = open(path, "wb")
+        self.index = open(path + ".idx", "wb")
+        self.data.write(MAGIC)
+        self.index.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.last_seq = -1
+        self.last_timestamp = 0.0
+        self.started = False
+        self.frames = 0
+        self.running = False
+        print(f"Recording {self.endpoint} to {path}")
+
+    def start(self):
+        self.running = True
+        for parts in request_snapshot(self.context, self.endpoint, self.layer):
+            self.write(parts)
+        while self.running:
+            try:
+                if self.screen_socket.poll(500):
+                    self.write(self.screen_socket.recv_multipart(copy=False))
+                self.send_report()
+            except zmq.error.ContextTerminated:
+                break
+        self.screen_socket.close(linger=0)
+        self.control_socket.close(linger=0)
+        self.data.close()
+        self.index.close()
+        print(f"Recorded {self.frames} frames to {self.path}")
+
+    def request_keyframe(self):
+        # After a gap the file only continues at a keyframe; one sent to everyone costs less than the
+        # whole snapshot again, which would rewind the recording to the last keyframe
+        if self.keyframe_requested is None or time.monotonic() - self.keyframe_requested >= 1.0:
+            self.keyframe_requested = time.monotonic()
+            try:
+                self.control_socket.send_json({"type": "keyframe", "layer": self.layer, "seq": self.last_seq},
+                                             zmq.NOBLOCK)
+            except zmq.Again:
+                pass  # Control channel unreachable; the periodic keyframe will do
+
+    def send_report(self):
+        # Once a second, so the host only negotiates codecs that playback on this machine decodes
+        if time.monotonic() - self.reported >= 1.0:
+            self.reported = time.monotonic()
+            try:
+                self.control_socket.send_json(decoder_report(self.last_seq, self.layer), zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+
+    def write(self, parts):
+        message = parse_frame(parts)
+        if message is None:
+            return
+        header = message.header
+        lost = self.sequence.lost
+        if not self.sequence.accept(header):
+            return
+        if header.seq <= self.last_seq and not (keyframe(header) and header.timestamp > self.last_timestamp):
+            return  # Already recorded, e.g. both in the snapshot and queued on the socket; a restarted host is fine
+        if self.sequence.lost > lost and not keyframe(header):
+            self.started = False  # This delta and the ones after it build on a frame that never arrived
+            self.request_keyframe()
+        if keyframe(header):
+            self.started = True
+            # Data before index, so the index never points past what is on disk
+            self.data.flush()
+            self.index.write(np.array([(header.timestamp, self.offset, header.seq)], dtype=INDEX_DTYPE).tobytes())
+            self.index.flush()
+        elif not self.started:
+            return  # Nothing to decode this delta against
+        lengths = np.array([len(part) for part in parts], dtype=LENGTH_DTYPE)
+        self.data.write(RECORD.pack(lengths.nbytes + int(lengths.sum()), len(parts)))
+        self.data.write(lengths.tobytes())
+        for part in parts:
+            self.data.write(part.buffer if hasattr(part, "buffer") else part)
+        self.offset += RECORD.size + lengths.nbytes + int(lengths.sum())
+        self.last_seq = header.seq
+        self.last_timestamp = header.timestamp
+        self.frames += 1
+
+    def stop(self):
+        self.running = False
+        if self.own_context:
+            self.context.term()
+
+
+class Recording:
+    # Memory-maps a recording; opening costs the same for a minute or a whole day
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a screen recording")
+        index_size = os.path.getsize(path + ".idx") - len(MAGIC)
+        count = max(0, index_size) // INDEX_DTYPE.itemsize
+        if count:
+            self.index = np.memmap(path + ".idx", dtype=INDEX_DTYPE, mode="r", offset=len(MAGIC), shape=(count,))
+        else:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        # A recorder killed mid-write can leave index entries past the end of the data
+        self.index = self.index[self.index["offset"] < len(self.data)]
+        if not len(self.index):
+            raise ValueError(f"{path} contains no keyframes")
+
+    @property
+    def start(self):
+        return float(self.index["timestamp"][0])
+
+    def seek(self, timestamp):
+        # Offset of the keyframe that opens the segment holding timestamp
+        position = max(0, np.searchsorted(self.index["timestamp"], timestamp, side="right") - 1)
+        return int(self.index["offset"][position])
+
+    def messages(self, offset):
+        # Yields the parts of each record from offset on, as views into the mapped file
+        view = memoryview(self.data)
+        while offset + RECORD.size <= len(self.data):
+            size, count = RECORD.unpack_from(self.data, offset)
+            body = offset + RECORD.size
+            if body + size > len(self.data):
+                return  # Record still being written
+            lengths = np.frombuffer(self.data, dtype=LENGTH_DTYPE, count=count, offset=body)
+            ends = body + lengths.nbytes + np.cumsum(lengths)
+            yield [view[end - length:end] for end, length in zip(ends.tolist(), lengths.tolist())]
+            offset = body + size
+
+    def frames(self, timestamp=None):
+        # Yields (message, visible) from the keyframe before timestamp on; frames ahead of timestamp are
+        # only there to decode against and come with visible False
+        offset = self.seek(timestamp) if timestamp is not None else self.seek(self.start)
+        for parts in self.messages(offset):
+            message = parse_frame(parts)
+            if message is not None:
+                yield message, timestamp is None or message.header.timestamp >= timestamp
+
+
+class Player:
+    # Plays a recording at its original pace: space pauses, j and l jump 10 s, the slider seeks, q quits
+    def __init__(self, path, speed=1.0):
+        self.recording = Recording(path)
+        self.speed = speed
+        self.screen = TileCanvas(cv2.IMREAD_COLOR)
+        self.window = os.path.basename(path)
+        self.seek_to = None
+        self.position = self.recording.start
+        self.clock = None  # (recording time, wall time) the playback pace is measured from
+
+    def play(self, start=0.0):
+        end = float(self.recording.index["timestamp"][-1])
+        cv2.namedWindow(self.window, cv2.WINDOW_NORMAL)
+        cv2.createTrackbar("seconds", self.window, int(start), max(1, int(end - self.recording.start) + 60),
+                           self.on_slider)
+        self.seek_to = self.recording.start + start
+        while self.seek_to is not None:
+            target, self.seek_to = self.seek_to, None
+            if not self.play_from(target):
+                break
+        cv2.destroyWindow(self.window)
+
+    def play_from(self, target):
+        # Returns True after a seek, False when the viewer quits
+        self.clock = None
+        for message, visible in self.recording.frames(target):
+            if not self.screen.apply(message) or not visible:
+                continue
+            self.position = message.header.timestamp
+            if self.clock is None:
+                self.clock = (self.position, time.monotonic())
+            cv2.imshow(self.window, self.screen.picture(cv2.COLOR_YUV2BGR_I420))
+            delay = self.clock[1] + (self.position - self.clock[0]) / self.speed - time.monotonic()
+            if not self.wait(delay):
+                return False
+            if self.seek_to is not None:
+                return True
+        while self.seek_to is None:  # Hold the last frame at the end of the recording
+            if not self.wait(0.2):
+                return False
+        return True
+
+    def wait(self, delay):
+        # Handles keys for delay seconds, or for as long as playback is paused
+        key = cv2.waitKey(max(1, int(1000 * delay)))
+        paused_at = None
+        while True:
+            if key in (ord("q"), 27):
+                return False
+            if key in (ord("j"), ord("l")):
+                self.seek_to = self.position + (10 if key == ord("l") else -10)
+            elif key == ord(" "):
+                if paused_at is None:
+                    paused_at = time.monotonic()
+                else:
+                    self.clock = (self.clock[0], self.clock[1] + time.monotonic() - paused_at)
+                    paused_at = None
+            if paused_at is None or self.seek_to is not None:
+                return True
+            key = cv2.waitKey(50)
+
+    def on_slider(self, value):
+        self.seek_to = self.recording.start + value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record a screen share or play a recording back")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record = commands.add_parser("record")
+    record.add_argument("server", help="Server or relay as host[:port] or a zmq endpoint")
+    record.add_argument("path")
+    record.add_argument("--layer", choices=list(SIMULCAST_LAYERS), default=DEFAULT_LAYER)
+    play = commands.add_parser("play")
+    play.add_argument("path")
+    play.add_argument("--start", type=float, default=0.0, help="Seconds into the recording")
+    play.add_argument("--speed", type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        recorder = Recorder(None, None, args.path, endpoint=server_endpoint(args.server), layer=args.layer)
+        try:
+            recorder.start()
+        except KeyboardInterrupt:
+            recorder.stop()
+    else:
+        Player(args.path, args.speed).play(args.start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import collections
+import socket
+import threading
+import time
+import zmq
+from adaptive import ViewerLag
+from discovery import Beacon, discover, local_ip
+from metrics import create_metrics, serve_metrics
+from pro import (CONTROL_PORT_OFFSET, CURSOR_PORT_OFFSET, DEFAULT_LAYER, SNAPSHOT_PORT_OFFSET, STREAM_CAPS,
+                 offset_endpoint, request_snapshot, server_endpoint)
+from protocol import LAYER_PREFIX, SequenceTracker, keyframe, layer_name, layer_topic, pack_snapshot, parse_frame
+
+
+class LayerCache:
+    # Same keyframe-plus-deltas cache a Server keeps per simulcast layer, so late joiners don't have to
+    # reach past the relay. snapshot is None while the cache is stale: from a lost frame or too many
+    # deltas until the next keyframe, during which snapshot requests for the layer are passed upstream.
+    def __init__(self):
+        self.snapshot = None
+        self.sequence = SequenceTracker()
+        self.relayed_seq = -1
+
+
+class Relay:
+    # Subscribes once to a Server and republishes to any number of viewers. It binds the same port
+    # layout as a Server (screen, control +2, snapshot +3, cursor +4), so viewers and further relays in other
+    # subnets connect to it exactly as they would to the presenting machine.
+    def __init__(self, upstream, port, context=None, endpoint=None, max_snapshot_deltas=120,
+                 metrics=False, stats_port=None, send_hwm=16, stream=None, caps=None):
+        self.upstream = upstream
+        self.port = port
+        self.metrics = create_metrics(metrics or stats_port)
+        self.viewer_lag = ViewerLag()
+        self.subscriptions = collections.Counter()  # Viewers and relays downstream, per topic
+        self.metrics.gauge("subscriptions", lambda: sum(self.subscriptions.values()))
+        self.metrics.gauge("viewer_queue_depth", self.viewer_lag.depths)
+        if stats_port:
+            serve_metrics(self.metrics, stats_port)
+        self.own_context = context is None
+        self.context = context or zmq.Context()
+        self.endpoint = endpoint or f"tcp://*:{self.port}"
+        self.upstream_socket = self.context.socket(zmq.XSUB)
+        self.upstream_socket.connect(upstream)
+        # Subscribed to the default layer on its own behalf so its cache stays warm while nobody is
+        # watching. Other layers only flow, and are only cached, while someone downstream subscribes.
+        self.default_topic = layer_topic(DEFAULT_LAYER)
+        self.upstream_socket.send(b"\x01" + self.default_topic)
+        self.viewer_socket = self.context.socket(zmq.XPUB)
+        # Pass every (un)subscription through so joining and leaving viewers and relays can be counted
+        self.viewer_socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+        self.viewer_socket.setsockopt(zmq.SNDHWM, send_hwm)  # A slow viewer loses frames, not the relay's memory
+        self.viewer_socket.bind(self.endpoint)
+        self.control_socket = self.context.socket(zmq.PULL)
+        self.control_socket.bind(offset_endpoint(self.endpoint, CONTROL_PORT_OFFSET))
+        self.forward_socket = self.context.socket(zmq.PUSH)
+        self.forward_socket.setsockopt(zmq.LINGER, 0)
+        self.forward_socket.connect(offset_endpoint(upstream, CONTROL_PORT_OFFSET))
+        self.snapshot_socket = self.context.socket(zmq.ROUTER)
+        self.snapshot_socket.bind(offset_endpoint(self.endpoint, SNAPSHOT_PORT_OFFSET))
+        self.cursor_in = self.context.socket(zmq.SUB)
+        self.cursor_in.connect(offset_endpoint(upstream, CURSOR_PORT_OFFSET))
+        self.cursor_in.setsockopt_string(zmq.SUBSCRIBE, "")
+        self.cursor_out = self.context.socket(zmq.PUB)
+        self.cursor_out.setsockopt(zmq.SNDHWM, send_hwm)
+        self.cursor_out.bind(offset_endpoint(self.endpoint, CURSOR_PORT_OFFSET))
+        self.caches = {self.default_topic: LayerCache()}
+        self.snapshot_lock = threading.Lock()
+        self.max_snapshot_deltas = max_snapshot_deltas
+        # Announced under the upstream's stream id so viewers treat it as another copy of that stream
+        self.beacon = Beacon(self.port, "relay", stream, caps=caps or STREAM_CAPS) if stream else None
+        self.running = False
+        print(f"Relaying {upstream} on port {self.port}")
+
+    def start(self):
+        self.running = True
+        if self.beacon:
+            self.beacon.start()
+        threads = [threading.Thread(target=self.relay_frames), threading.Thread(target=self.forward_control),
+                   threading.Thread(target=self.serve_snapshots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def relay_frames(self):
+        poller = zmq.Poller()
+        poller.register(self.upstream_socket, zmq.POLLIN)
+        poller.register(self.viewer_socket, zmq.POLLIN)
+        poller.register(self.cursor_in, zmq.POLLIN)
+        while self.running:
+            try:
+                ready = dict(poller.poll(500))
+                if self.viewer_socket in ready:
+                    subscription = self.viewer_socket.recv()
+                    self.track_subscription(subscription)
+                    self.upstream_socket.send(subscription)
+                if self.upstream_socket in ready:
+                    parts = self.upstream_socket.recv_multipart(copy=False)
+                    started = time.perf_counter()
+                    self.viewer_socket.send_multipart(parts, copy=False)
+                    self.metrics.record("relay", time.perf_counter() - started)
+                    self.metrics.count("frames_relayed")
+                    self.metrics.count("bytes_relayed", sum(len(part) for part in parts))
+                    self.cache_frame(parts[0].bytes, parts)
+                if self.cursor_in in ready:
+                    self.cursor_out.send_multipart(self.cursor_in.recv_multipart(copy=False), copy=False)
+            except zmq.error.ContextTerminated:
+                break
+        self.upstream_socket.close(linger=0)
+        self.viewer_socket.close(linger=0)
+        self.cursor_in.close(linger=0)
+        self.cursor_out.close(linger=0)
+
+    def track_subscription(self, subscription):
+        # A layer nobody downstream subscribes to any more stops flowing, so its cache would go stale
+        self.subscriptions[subscription[1:]] += 1 if subscription[:1] == b"\x01" else -1
+        prefixes = [topic for topic, count in self.subscriptions.items() if count > 0]
+        with self.snapshot_lock:
+            self.caches = {topic: cache for topic, cache in self.caches.items()
+                           if topic == self.default_topic or any(topic.startswith(prefix) for prefix in prefixes)}
+
+    def cache_frame(self, topic, parts):
+        # Runs on the forwarding loop, so it never waits on upstream; a stale cache just waits for a keyframe
+        message = parse_frame(parts)
+        if message is None or not topic.startswith(LAYER_PREFIX):
+            return
+        header = message.header
+        with self.snapshot_lock:
+            cache = self.caches.setdefault(topic, LayerCache())
+            lost = cache.sequence.lost
+            if not cache.sequence.accept(header):
+                return
+            cache.relayed_seq = header.seq
+            intact = cache.snapshot is not None and cache.sequence.lost == lost
+            if keyframe(header):
+                cache.snapshot = [parts]
+            elif intact and len(cache.snapshot) < self.max_snapshot_deltas:
+                cache.snapshot.append(parts)
+            else:
+                cache.snapshot = None
+
+    def serve_snapshots(self):
+        while self.running:
+            try:
+                if not self.snapshot_socket.poll(500):
+                    continue
+                identity, _, topic = self.snapshot_socket.recv_multipart()
+                if not topic.startswith(LAYER_PREFIX):
+                    topic = self.default_topic
+                with self.snapshot_lock:
+                    cache = self.caches.get(topic)
+                    messages = list(cache.snapshot) if cache and cache.snapshot is not None else None
+                if messages is None:
+                    # A layer that isn't flowing through here yet (the viewer's subscription is still on
+                    # its way upstream) or whose cache is stale: pass the request on
+                    messages = request_snapshot(self.context, self.upstream, layer_name(topic))
+                    self.metrics.count("snapshots_fetched")
+                self.snapshot_socket.send_multipart([identity, b""] + pack_snapshot(messages), copy=False)
+                self.metrics.count("snapshots_served")
+            except zmq.error.ContextTerminated:
+                break
+        self.snapshot_socket.close(linger=0)
+
+    def forward_control(self):
+        # Viewer reports and region changes go on to the server, which adapts to the worst viewer
+        # behind every relay; queue depth is measured here against what this relay has sent.
+        # Anything that isn't a JSON object is dropped here rather than passed upstream.
+        try:
+            while self.running:
+                try:
+                    if not self.control_socket.poll(500):
+                        continue
+                    message = self.control_socket.recv_json()
+                    layer = message.get("layer", DEFAULT_LAYER)
+                    cache = self.caches.get(layer_topic(layer)) if isinstance(layer, str) else None
+                    seq = message.get("seq")
+                    if (message.get("type") == "report" and isinstance(message.get("viewer"), str) and cache
+                            and isinstance(seq, int)):
+                        self.viewer_lag.update(message["viewer"], seq, cache.relayed_seq)
+                    try:
+                        self.forward_socket.send_json(message, zmq.NOBLOCK)
+                    except zmq.Again:
+                        pass  # Upstream control channel unreachable; the stream itself keeps flowing
+                except zmq.error.ContextTerminated:
+                    break
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    print(f"Ignoring malformed control message: {e!r}")
+        finally:
+            self.control_socket.close(linger=0)
+            self.forward_socket.close(linger=0)
+
+    def stop(self):
+        self.running = False
+        if self.beacon:
+            self.beacon.stop()
+        if self.own_context:
+            self.context.term()
+        print("Relay stopped")
+
+
+def upstream_announcement(endpoint):
+    # Beacon of the upstream server or relay, or None when it can't be heard
+    host, _, port = endpoint.rpartition("://")[2].rpartition(":")
+    try:
+        ips = {socket.gethostbyname(host)}
+    except OSError:
+        return None
+    if any(ip.startswith("127.") for ip in ips):
+        ips.add(local_ip())  # Beacons from this machine arrive from its LAN address
+    for announcement in discover().values():
+        if announcement["ip"] in ips and str(announcement["port"]) == port:
+            return announcement
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Republish one screen share to many viewers")
+    parser.add_argument("upstream", help="Server or relay to subscribe to, as host[:port] or a zmq endpoint")
+    parser.add_argument("--port", type=int, required=True, help="Port viewers connect to")
+    parser.add_argument("--stats-port", type=int, help="Serve metrics, including per-viewer queue depth")
+    parser.add_argument("--max-snapshot-deltas", type=int, default=120)
+    parser.add_argument("--no-announce", action="store_true", help="Don't advertise the relay to viewers")
+    args = parser.parse_args()
+
+    upstream = server_endpoint(args.upstream)
+    announcement = None if args.no_announce else upstream_announcement(upstream)
+    if announcement is None and not args.no_announce:
+        print("Upstream not heard on the LAN, so viewers won't be told about this relay")
+    # Passes on what upstream offers (codecs, layers), except its multicast group, which it serves itself
+    caps = {key: value for key, value in (announcement or {}).get("caps", {}).items() if key != "multicast"}
+    relay = Relay(upstream, args.port, max_snapshot_deltas=args.max_snapshot_deltas, stats_port=args.stats_port,
+                  stream=announcement and announcement["stream"], caps=caps or None)
+    try:
+        relay.start()
+    except KeyboardInterrupt:
+        relay.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import sys
+from pro import main
+
+# Starts the server directly, without the chooser window; pro.py loads the rest on first use
+if __name__ == "__main__":
+    main(["server"] + sys.argv[1:])
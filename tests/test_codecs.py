@@ -0,0 +1,108 @@
+import cv2
+import numpy as np
+import pytest
+import bench
+import tiles
+from protocol import parse_frame
+
+CODEC_NAMES = tiles.codec_names()
+FLAGS = {1: cv2.IMREAD_GRAYSCALE, 3: cv2.IMREAD_COLOR}
+
+
+def screen_tile(channels, width=64, height=48):
+    # White background, dark text, a colored bar and a smooth gradient: the mix tiles see in practice
+    tile = np.full((height, width, 3), 255, dtype=np.uint8)
+    cv2.putText(tile, "def f(x):", (2, 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (20, 20, 20), 1)
+    cv2.rectangle(tile, (0, 20), (width, 28), (200, 60, 30), -1)
+    tile[32:] = np.linspace(0, 255, width, dtype=np.uint8)[None, :, None]
+    return tile if channels == 3 else cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY)
+
+
+def round_trip(name, tile, reduction=1, quality=80):
+    codec = tiles.CODECS[name]
+    payload = bytes(memoryview(codec.encode(tile, quality)))
+    height, width = tile.shape[:2]
+    return codec.decode(payload, width, height, FLAGS[1 if tile.ndim == 2 else 3], reduction)
+
+
+def test_registry_has_every_codec_by_id_and_name():
+    for name in CODEC_NAMES:
+        codec = tiles.CODECS[name]
+        assert tiles.CODECS[codec.id] is codec
+
+
+@pytest.mark.parametrize("channels", [1, 3])
+@pytest.mark.parametrize("name", CODEC_NAMES)
+def test_round_trip(name, channels):
+    tile = screen_tile(channels)
+    decoded = round_trip(name, tile)
+    assert decoded.shape == tile.shape and decoded.dtype == np.uint8
+    error = np.abs(decoded.astype(int) - tile.astype(int))
+    if tiles.CODECS[name].lossless:
+        assert error.max() == 0
+    elif name == "palette":
+        # Over max_colors the gradient is posterized: 2 levels a channel for 16 colors, 16 for gray
+        levels = 16 if channels == 1 else 2
+        assert error.max() <= 255 // (levels - 1) // 2 + 1
+    else:
+        assert error.mean() < 8
+
+
+@pytest.mark.parametrize("channels", [1, 3])
+@pytest.mark.parametrize("name", CODEC_NAMES)
+def test_flat_black_and_white_survive(name, channels):
+    for value in (0, 255):
+        flat = np.full_like(screen_tile(channels), value)
+        assert np.abs(round_trip(name, flat, quality=40).astype(int) - value).max() <= 2
+
+
+@pytest.mark.parametrize("name", CODEC_NAMES)
+def test_reduced_decode_size(name):
+    tile = screen_tile(1, width=60, height=45)
+    for reduction in (2, 4, 8):
+        decoded = round_trip(name, tile, reduction)
+        assert decoded.shape == (-(-45 // reduction), -(-60 // reduction))
+
+
+def test_palette_posterizes_without_wrapping():
+    # Too many colors for the palette: white must not wrap around when levels are rounded
+    tile = np.full((64, 64, 3), 255, dtype=np.uint8)
+    tile[:32] = np.random.default_rng(0).integers(0, 256, (32, 64, 3), dtype=np.uint8)
+    decoded = round_trip("palette", tile)
+    assert (decoded[32:] == 255).all()
+    assert np.abs(decoded.astype(int) - tile.astype(int)).max() <= 255 // 2 + 1  # 2 levels a channel
+
+
+@pytest.mark.parametrize("channels", [1, 3])
+def test_palette_of_noisy_tile_fits_max_colors(channels):
+    codec = tiles.CODECS["palette"]
+    tile = np.random.default_rng(1).integers(0, 256, (64, 64, channels), dtype=np.uint8).squeeze()
+    payload = bytes(memoryview(codec.encode(tile, 80)))
+    _, _, last = tiles.PALETTE_HEADER.unpack_from(payload)
+    assert last + 1 <= codec.max_colors
+
+
+def test_hybrid_frame_keeps_inner_payloads():
+    # Each tile's codec travels in its rect, and the payload is exactly what the inner codec produced
+    frame = cv2.cvtColor(bench.MixedDesktop(640, 360)(), cv2.COLOR_RGB2GRAY)
+    encoder = tiles.DeltaEncoder(codec="hybrid", quality=80)
+    message = parse_frame(encoder.next_message(frame))
+    assert set(message.codecs.tolist()) == {tiles.CODECS["zlib"].id, tiles.CODECS["jpeg"].id}
+    for (x, y, w, h), payload, codec_id in zip(message.rects, message.payloads, message.codecs):
+        expected = tiles.CODECS[int(codec_id)].encode(frame[y:y + h, x:x + w], 80)
+        assert bytes(payload) == bytes(memoryview(expected))
+    canvas = tiles.TileCanvas(cv2.IMREAD_GRAYSCALE)
+    assert canvas.apply(message)
+    text = message.codecs == tiles.CODECS["zlib"].id
+    x, y, w, h = message.rects[text][0]
+    assert (canvas.buffer[y:y + h, x:x + w] == frame[y:y + h, x:x + w]).all()
+
+
+@pytest.mark.parametrize("region", [(0, 0, 640, 360), (1, 3, 77, 200), (100, 50, 101, 51), (639, 359, 640, 360)])
+def test_yuv420_region_matches_whole_picture(region):
+    # Cutting the planes first and converting only the region gives the same pixels as converting it all
+    packed = tiles.rgb_to_yuv420(bench.MixedDesktop(640, 360)())
+    left, top, right, bottom = region
+    whole = tiles.yuv420_to_rgb(packed)
+    assert tiles.yuv420_size(packed) == whole.shape[:2]
+    assert (tiles.yuv420_to_rgb(packed, region=region) == whole[top:bottom, left:right]).all()
@@ -0,0 +1,58 @@
+import numpy as np
+import protocol
+from multicast import MulticastSender, Reassembler, group_size
+
+
+class Captured:
+    # Stands in for the sender's socket, keeping the datagrams instead of sending them
+    def __init__(self):
+        self.datagrams = []
+
+    def sendto(self, datagram, address):
+        self.datagrams.append(datagram)
+
+    def close(self):
+        pass
+
+
+def sent(parts, **options):
+    sender = MulticastSender("239.255.77.78", 5599, **options)
+    sender.socket.close()
+    sender.socket = Captured()
+    sender.send(parts)
+    return sender.socket.datagrams
+
+
+def message(size):
+    return [b"layer/full/", np.random.default_rng(size).integers(0, 256, size, dtype=np.uint8).tobytes()]
+
+
+def test_big_messages_get_smaller_parity_groups():
+    assert group_size(1, 8, 0.01) == 8
+    assert group_size(250, 8, 0.01) < 8
+    assert group_size(250, 8, 0.0) == 8
+
+
+def test_one_lost_datagram_per_group_is_rebuilt():
+    parts = message(300000)
+    datagrams = sent(parts)
+    header, _ = protocol.parse_datagram(datagrams[0])
+    assert header.parity > header.data // 8  # A keyframe this size gets more than one parity per 8
+    reassembler = Reassembler()
+    delivered = []
+    for index, datagram in enumerate(datagrams):
+        if index >= header.parity:
+            delivered += reassembler.add(datagram)  # The first datagram of every group is lost
+    assert [[bytes(part) for part in parts] for parts in delivered] == [parts]
+    assert reassembler.recovered == header.parity
+
+
+def test_viewer_that_never_completed_a_message_counts_it_lost():
+    reassembler = Reassembler(timeout=0.0)
+    first = sent(message(5000))
+    reassembler.add(first[0])  # The rest of the viewer's first message never arrives
+    header, _ = protocol.parse_datagram(first[0])
+    later = [protocol.pack_datagram(header.session, header.seq + 1, 0, 1, 0, 4, b"\0\0\0\0")]
+    for datagram in later * 2:
+        reassembler.add(datagram)
+    assert reassembler.lost == 1
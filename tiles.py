@@ -0,0 +1,463 @@
+import struct
+import time
+import zlib
+import cv2
+import numpy as np
+from protocol import (CODEC_HYBRID, CODEC_JPEG, CODEC_LZ4, CODEC_PALETTE, CODEC_PNG, CODEC_WEBP, CODEC_ZLIB,
+                      FLAG_YUV420, keyframe, pack_frame)
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+KEYFRAME = True
+DELTA = False
+
+# libjpeg can decode straight to 1/2, 1/4 or 1/8 scale, skipping most of the IDCT work
+REDUCED_FLAGS = {
+    cv2.IMREAD_GRAYSCALE: {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                           8: cv2.IMREAD_REDUCED_GRAYSCALE_8},
+    cv2.IMREAD_COLOR: {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8},
+}
+PALETTE_HEADER = struct.Struct("!BBB")  # channels, bits per index, palette size - 1
+
+
+# Tile codecs are stateless, so one instance per codec is shared by every encoder and canvas.
+# encode(tile, quality) returns the payload for one tile; decode(payload, width, height, flag, reduction)
+# returns it in the canvas layout, cv2.IMREAD_GRAYSCALE or cv2.IMREAD_COLOR, at 1/reduction of the size.
+def _fit(tile, flag, reduction=1):
+    # Matches a decoded tile to the canvas: channel count first, then the reduced size
+    if tile.ndim == 2 and flag == cv2.IMREAD_COLOR:
+        tile = cv2.cvtColor(tile, cv2.COLOR_GRAY2BGR)
+    elif tile.ndim == 3 and flag == cv2.IMREAD_GRAYSCALE:
+        tile = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY)
+    if reduction > 1:
+        height, width = tile.shape[:2]
+        tile = cv2.resize(tile, (-(-width // reduction), -(-height // reduction)), interpolation=cv2.INTER_AREA)
+    return tile
+
+
+def _raw(data, width, height):
+    pixels = np.frombuffer(data, dtype=np.uint8)
+    channels = len(pixels) // (width * height)
+    return pixels.reshape((height, width, channels) if channels > 1 else (height, width))
+
+
+class JpegCodec:
+    id = CODEC_JPEG
+    name = "jpeg"
+    lossless = False
+
+    def encode(self, tile, quality):
+        return cv2.imencode(".jpg", tile, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])[1]
+
+    def decode(self, payload, width, height, flag, reduction=1):
+        # libjpeg does the reduction itself and skips most of the IDCT work
+        flag = REDUCED_FLAGS[flag][reduction] if reduction > 1 else flag
+        return cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), flag)
+
+
+class PngCodec:
+    # Lossless; the fastest deflate level, since screen content compresses well even then
+    id = CODEC_PNG
+    name = "png"
+    lossless = True
+
+    def encode(self, tile, quality):
+        return cv2.imencode(".png", tile, [cv2.IMWRITE_PNG_COMPRESSION, 1])[1]
+
+    def decode(self, payload, width, height, flag, reduction=1):
+        tile = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), flag)
+        return None if tile is None else _fit(tile, flag, reduction)
+
+
+class WebpCodec:
+    # Lossy at quality up to 100, smaller than JPEG at the same quality but slower to encode
+    id = CODEC_WEBP
+    name = "webp"
+    lossless = False
+
+    def encode(self, tile, quality):
+        return cv2.imencode(".webp", tile, [cv2.IMWRITE_WEBP_QUALITY, max(1, int(quality))])[1]
+
+    def decode(self, payload, width, height, flag, reduction=1):
+        tile = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), flag)
+        return None if tile is None else _fit(tile, flag, reduction)
+
+
+class ZlibCodec:
+    # Raw pixels through deflate at level 1: lossless and cheap on both ends
+    id = CODEC_ZLIB
+    name = "zlib"
+    lossless = True
+
+    def encode(self, tile, quality):
+        return zlib.compress(np.ascontiguousarray(tile), 1)
+
+    def decode(self, payload, width, height, flag, reduction=1):
+        return _fit(_raw(zlib.decompress(payload), width, height), flag, reduction)
+
+
+class Lz4Codec:
+    # Raw pixels through LZ4: bigger than zlib, but several times faster in both directions
+    id = CODEC_LZ4
+    name = "lz4"
+    lossless = True
+
+    def encode(self, tile, quality):
+        return lz4.frame.compress(np.ascontiguousarray(tile), compression_level=0)
+
+    def decode(self, payload, width, height, flag, reduction=1):
+        return _fit(_raw(lz4.frame.decompress(payload), width, height), flag, reduction)
+
+
+class PaletteCodec:
+    # For text and UI: tiles with at most max_colors colors are coded losslessly as a palette and
+    # packed 1, 2, 4 or 8 bit indices, then deflated. Busier tiles are posterized until they fit,
+    # which keeps glyph edges sharp where JPEG would ring.
+    id = CODEC_PALETTE
+    name = "palette"
+    lossless = False
+
+    def __init__(self, max_colors=16):
+        self.max_colors = max_colors
+
+    def encode(self, tile, quality):
+        channels = 1 if tile.ndim == 2 else tile.shape[2]
+        palette, indices = self.index(tile, channels)
+        if len(palette) > self.max_colors:
+            # Levels per channel whose every combination still fits in max_colors
+            levels = round(self.max_colors ** (1 / channels))
+            levels = max(2, levels - (levels ** channels > self.max_colors))
+            # Evenly spaced levels from 0 to 255, so black and white stay exact; uint16 keeps the products
+            # from wrapping
+            steps = (tile.astype(np.uint16) * (levels - 1) + 127) // 255
+            palette, indices = self.index((steps * 255 // (levels - 1)).astype(np.uint8), channels)
+        bits = next(bits for bits in (1, 2, 4, 8) if len(palette) <= 1 << bits)
+        per_byte = 8 // bits
+        indices = np.concatenate([indices, np.zeros(-len(indices) % per_byte, dtype=np.uint8)])
+        indices = indices.reshape(-1, per_byte)
+        packed = np.zeros(len(indices), dtype=np.uint8)
+        for i in range(per_byte):
+            packed |= indices[:, i] << (bits * i)
+        return (PALETTE_HEADER.pack(channels, bits, len(palette) - 1) + palette.tobytes()
+                + zlib.compress(packed, 1))
+
+    @staticmethod
+    def index(tile, channels):
+        # (palette as uint8 rows, index of every pixel); a bincount is much quicker than sorting for gray
+        if channels == 1:
+            flat = tile.reshape(-1)
+            palette = np.flatnonzero(np.bincount(flat, minlength=256)).astype(np.uint8)
+            lookup = np.zeros(256, dtype=np.uint8)
+            lookup[palette] = np.arange(len(palette))
+            return palette, lookup[flat]
+        keys = np.zeros(tile.shape[:2], dtype=np.uint32)
+        for channel in range(channels):
+            keys = (keys << 8) | tile[..., channel]
+        keys, indices = np.unique(keys.reshape(-1), return_inverse=True)
+        if len(keys) > 256:
+            return keys, None  # Too many to index; the caller posterizes first
+        palette = np.stack([(keys >> (8 * (channels - 1 - channel))) & 0xFF for channel in range(channels)], axis=1)
+        return palette.astype(np.uint8), indices.astype(np.uint8)
+
+    def decode(self, payload, width, height, flag, reduction=1):
+        channels, bits, size = PALETTE_HEADER.unpack_from(payload)
+        start = PALETTE_HEADER.size
+        palette = np.frombuffer(payload, dtype=np.uint8, count=(size + 1) * channels, offset=start)
+        packed = np.frombuffer(zlib.decompress(payload[start + len(palette):]), dtype=np.uint8)
+        per_byte = 8 // bits
+        indices = np.empty((len(packed), per_byte), dtype=np.uint8)
+        for i in range(per_byte):
+            indices[:, i] = (packed >> (bits * i)) & ((1 << bits) - 1)
+        pixels = palette.reshape(-1, channels)[indices.reshape(-1)[:width * height]]
+        tile = pixels.reshape((height, width, channels) if channels > 1 else (height, width))
+        return _fit(tile, flag, reduction)
+
+
+def classify_tiles(frame, tile_size, max_colors=200, min_edges=0.05, min_dominant=0.4):
+    # True for text and UI tiles, False for natural images, per tile_size tile of frame. Text and UI sit
+    # on flat backgrounds, so one level covers much of the tile (min_dominant); where it doesn't, hard
+    # edges with a limited number of levels (diagrams, text on gradients) still count. Photos and video
+    # have neither: smooth regions have few levels but no dominant one, busy ones too many levels.
+    # One bincount over (tile, level) pairs gives every tile's histogram at once.
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    # Every other pixel each way is plenty to tell text from photos, at a quarter of the work
+    gray = gray[::2, ::2]
+    tile_size //= 2
+    height, width = gray.shape
+    rows, cols = -(-height // tile_size), -(-width // tile_size)
+    if (rows * tile_size, cols * tile_size) != (height, width):
+        gray = np.pad(gray, ((0, rows * tile_size - height), (0, cols * tile_size - width)), mode="edge")
+    blocks = gray.reshape(rows, tile_size, cols, tile_size).swapaxes(1, 2).reshape(rows * cols, -1)
+    keys = (np.arange(rows * cols, dtype=np.int32)[:, None] << 8) | blocks
+    histograms = np.bincount(keys.reshape(-1), minlength=rows * cols * 256).reshape(rows * cols, 256)
+    colors = np.count_nonzero(histograms, axis=1)
+    dominant = histograms.max(axis=1) / blocks.shape[1]
+    # Horizontal steps of a quarter of the range or more; glyph stems are vertical, so this is enough
+    steps = np.zeros(gray.shape, dtype=bool)
+    steps[:, 1:] = cv2.absdiff(gray[:, 1:], gray[:, :-1]) >= 64
+    edges = steps.reshape(rows, tile_size, cols, tile_size).sum(axis=(1, 3)).reshape(-1) / blocks.shape[1]
+    return ((dominant >= min_dominant) | ((edges >= min_edges) & (colors <= max_colors))).reshape(rows, cols)
+
+
+class HybridCodec:
+    # Text and UI tiles go to a lossless codec so glyphs stay sharp, natural images to JPEG where lossless
+    # would be several times bigger. zlib keeps text exact at about half the size of JPEG at quality 80;
+    # palette is smaller again but posterizes antialiasing. Each payload starts with the id of the codec
+    # used, so viewers composite any mix. DeltaEncoder calls split() first to cut rects where the kind changes.
+    id = CODEC_HYBRID
+    name = "hybrid"
+    lossless = False
+
+    def __init__(self, text="zlib", photo="jpeg"):
+        self.text = text
+        self.photo = photo
+
+    def split(self, frame, rects, tile_size):
+        # [(rect, is text)] covering the same pixels as rects, which lie on the tile grid
+        pieces = []
+        for x, y, w, h in rects:
+            text = classify_tiles(frame[y:y + h, x:x + w], tile_size)
+            for kind in (True, False):
+                for row, start, end in _runs(text == kind):
+                    top, left = y + row * tile_size, x + start * tile_size
+                    pieces.append(((left, top, min(x + end * tile_size, x + w) - left,
+                                    min(tile_size, y + h - top)), kind))
+        return pieces
+
+    def tile_codec(self, text):
+        return CODECS[self.text if text else self.photo]
+
+    # In frames each tile's codec id travels in its rect (see protocol), and DeltaEncoder calls the inner
+    # codecs itself. A tile coded on its own starts with the id instead.
+    def encode(self, tile, quality, text=None):
+        if text is None:
+            text = bool(classify_tiles(tile, max(tile.shape[:2])).all())
+        codec = self.tile_codec(text)
+        return bytes([codec.id]) + bytes(memoryview(codec.encode(tile, quality)))
+
+    def decode(self, payload, width, height, flag, reduction=1):
+        codec = CODECS.get(payload[0])
+        if codec is None or codec is self:
+            return None
+        return codec.decode(payload[1:], width, height, flag, reduction)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    # Looked up by the id in each frame header and by name in configuration and negotiation
+    CODECS[codec.id] = codec
+    CODECS[codec.name] = codec
+
+
+def codec_names():
+    # Names this process can encode and decode, in registration order
+    return [name for name in CODECS if isinstance(name, str)]
+
+
+for codec in (JpegCodec(), PngCodec(), ZlibCodec(), PaletteCodec(), HybridCodec()):
+    register_codec(codec)
+if cv2.haveImageWriter(".webp"):
+    register_codec(WebpCodec())
+if lz4 is not None:
+    register_codec(Lz4Codec())
+
+
+def dirty_tiles(prev, frame, tile_size):
+    height, width = frame.shape[:2]
+    diff = prev != frame
+    if diff.ndim == 3:
+        diff = diff.any(axis=2)
+    row_starts = np.arange(0, height, tile_size)
+    col_starts = np.arange(0, width, tile_size)
+    dirty = np.logical_or.reduceat(diff, row_starts, axis=0)
+    dirty = np.logical_or.reduceat(dirty, col_starts, axis=1)
+
+    # Merge horizontal runs of dirty tiles so a changed line of text costs one JPEG, not ten
+    rects = []
+    for row, col_start, col_end in _runs(dirty):
+        x = col_start * tile_size
+        y = row * tile_size
+        rects.append((x, y, min(col_end * tile_size, width) - x, min(tile_size, height - y)))
+    return rects
+
+
+def _runs(dirty):
+    padded = np.zeros((dirty.shape[0], dirty.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = dirty
+    edges = np.diff(padded, axis=1)
+    start_rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return zip(start_rows.tolist(), starts.tolist(), ends.tolist())
+
+
+class DeltaEncoder:
+    def __init__(self, tile_size=64, keyframe_interval=2.0, max_dirty_ratio=0.5, codec="jpeg", quality=80):
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.max_dirty_ratio = max_dirty_ratio
+        self.codec = CODECS[codec]
+        self.quality = quality
+        self.prev = None
+        self.last_keyframe = 0.0
+        self.seq = 0
+
+    def force_keyframe(self):
+        self.last_keyframe = 0.0
+
+    def keyframe_due(self):
+        return self.prev is None or time.monotonic() - self.last_keyframe >= self.keyframe_interval
+
+    def diff(self, frame):
+        # Returns (kind, rects); rects is empty when nothing changed
+        height, width = frame.shape[:2]
+        now = time.monotonic()
+        if self.prev is None or self.prev.shape != frame.shape or self.keyframe_due():
+            self.prev = frame
+            self.last_keyframe = now
+            return KEYFRAME, [(0, 0, width, height)]
+
+        rects = dirty_tiles(self.prev, frame, self.tile_size)
+        self.prev = frame
+        dirty_area = sum(w * h for _, _, w, h in rects)
+        if dirty_area > self.max_dirty_ratio * width * height:
+            # One full JPEG beats lots of small ones once most of the screen moved
+            self.last_keyframe = now
+            return KEYFRAME, [(0, 0, width, height)]
+        return DELTA, rects
+
+    def encode(self, frame, rects, codec=None):
+        # Returns (rects, payloads); the hybrid codec cuts rects where text meets images and adds the codec
+        # id of each piece to its rect. Workers pass the codec they read before starting, so a switch
+        # mid-frame can't mix codecs.
+        codec = codec or self.codec
+        if isinstance(codec, HybridCodec):
+            pieces = [(rect, codec.tile_codec(text)) for rect, text in codec.split(frame, rects, self.tile_size)]
+            return ([rect + (tile_codec.id,) for rect, tile_codec in pieces],
+                    [tile_codec.encode(frame[y:y + h, x:x + w], self.quality) for (x, y, w, h), tile_codec in pieces])
+        return rects, [codec.encode(frame[y:y + h, x:x + w], self.quality) for x, y, w, h in rects]
+
+    def next_message(self, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        kind, rects = self.diff(frame)
+        if not rects:
+            return None
+        height, width = frame.shape[:2]
+        codec = self.codec
+        rects, payloads = self.encode(frame, rects, codec)
+        message = pack_frame(self.seq, timestamp, width, height, rects, payloads, kind, codec.id)
+        self.seq += 1
+        return message
+
+
+# Color frames travel as one 8-bit picture 1.5 times as tall as the screen: luma (Y) at full resolution
+# on top, the two chroma planes (U, V) at half width and half height side by side below it. Diffing,
+# every tile codec, the encoder pool and the canvas handle it exactly like a grayscale frame, and the
+# chroma adds half the pixels of the luma, mostly flat areas that compress to almost nothing.
+def rgb_to_yuv420(frame):
+    # Odd widths and heights lose their last column or row, since chroma covers 2x2 pixel blocks
+    height, width = frame.shape[0] & ~1, frame.shape[1] & ~1
+    i420 = cv2.cvtColor(frame[:height, :width], cv2.COLOR_RGB2YUV_I420)
+    u, v = i420[height:].reshape(2, height // 2, width // 2)
+    return np.vstack([i420[:height], np.hstack([u, v])])
+
+
+def yuv420_size(packed):
+    # (height, width) of the picture a packed YUV 4:2:0 array unpacks to
+    return round(packed.shape[0] * 2 / 3) & ~1, packed.shape[1] & ~1
+
+
+def yuv420_to_rgb(packed, conversion=cv2.COLOR_YUV2RGB_I420, region=None):
+    # Inverse of rgb_to_yuv420, also for canvases decoded at a reduced size; conversion picks RGB or BGR.
+    # region (left, top, right, bottom) converts only that part: the planes are cut at the even edges
+    # around it, since chroma covers 2x2 pixel blocks, and the odd row or column is trimmed afterwards.
+    height, width = yuv420_size(packed)
+    left, top, right, bottom = region or (0, 0, width, height)
+    x0, y0, x1, y1 = left & ~1, top & ~1, (right + 1) & ~1, (bottom + 1) & ~1
+    luma = round(packed.shape[0] * 2 / 3)
+    chroma = packed[luma + y0 // 2:luma + y1 // 2]
+    i420 = np.concatenate([packed[y0:y1, x0:x1].ravel(), chroma[:, x0 // 2:x1 // 2].ravel(),
+                           chroma[:, (width + x0) // 2:(width + x1) // 2].ravel()])
+    rgb = cv2.cvtColor(i420.reshape((y1 - y0) * 3 // 2, x1 - x0), conversion)
+    return rgb if (x0, y0, x1, y1) == (left, top, right, bottom) else rgb[top - y0:bottom - y0, left - x0:right - x0]
+
+
+def resize_yuv420(packed, factor):
+    # Scales each plane on its own, so no chroma bleeds into luma across the seams of the layout
+    height, width = packed.shape[0] * 2 // 3, packed.shape[1]
+    size = (max(2, round(width * factor)) & ~1, max(2, round(height * factor)) & ~1)
+    half = (size[0] // 2, size[1] // 2)
+    planes = (packed[height:, :width // 2], packed[height:, width // 2:])
+    return np.vstack([cv2.resize(packed[:height], size, interpolation=cv2.INTER_AREA),
+                      np.hstack([cv2.resize(plane, half, interpolation=cv2.INTER_AREA) for plane in planes])])
+
+
+class TileCanvas:
+    def __init__(self, imread_flag=cv2.IMREAD_COLOR):
+        self.imread_flag = imread_flag
+        self.reduction = 1
+        self.buffer = None
+        self.header = None
+
+    def set_reduction(self, reduction):
+        # The buffer is kept at 1/reduction of the encoded size; changing it needs a fresh keyframe
+        self.reduction = reduction
+        self.buffer = None
+
+    def packed(self):
+        # The YUV 4:2:0 layout of a color frame, or None for grayscale
+        if self.header is None or not self.header.flags & FLAG_YUV420:
+            return None
+        return self.buffer if self.buffer.ndim == 2 else self.buffer[..., 0]
+
+    def picture_shape(self):
+        # (height, width) of picture() without unpacking anything
+        packed = self.packed()
+        return self.buffer.shape[:2] if packed is None else yuv420_size(packed)
+
+    def picture(self, conversion=cv2.COLOR_YUV2RGB_I420, region=None):
+        # The buffer as it is shown, or its region (left, top, right, bottom): color frames are unpacked
+        # from their YUV 4:2:0 layout into a new array, converting only the region
+        packed = self.packed()
+        if packed is None:
+            return self.buffer if region is None else self.buffer[region[1]:region[3], region[0]:region[2]]
+        return yuv420_to_rgb(packed, conversion, region)
+
+    def apply(self, message):
+        # Patches the persistent buffer in place; returns False until a keyframe arrives
+        header = message.header
+        codec = CODECS.get(header.codec)
+        if codec is None:
+            print(f"No decoder for codec {header.codec}")
+            return False
+        n = self.reduction
+        codecs = [codec] * len(message.rects) if message.codecs is None else [CODECS.get(i) for i in message.codecs]
+        if None in codecs:
+            print(f"No decoder for a tile of a {codec.name} frame")
+            return False
+        if keyframe(header) and len(message.rects) == 1:
+            frame = codecs[0].decode(message.payloads[0], header.width, header.height, self.imread_flag, n)
+            if frame is None:
+                return False
+            self.buffer = frame if frame.flags.writeable else frame.copy()  # Raw codecs decode into bytes
+            self.header = header
+            return True
+
+        if keyframe(header):
+            # Keyframes in several pieces (hybrid coding) are assembled on a fresh buffer
+            channels = () if self.imread_flag == cv2.IMREAD_GRAYSCALE else (3,)
+            self.buffer = np.zeros((-(-header.height // n), -(-header.width // n)) + channels, dtype=np.uint8)
+        elif self.buffer is None or self.buffer.shape[:2] != (-(-header.height // n), -(-header.width // n)):
+            return False
+        self.header = header
+        for (x, y, w, h), payload, tile_codec in zip(message.rects, message.payloads, codecs):
+            tile = tile_codec.decode(payload, w, h, self.imread_flag, n)
+            if tile is not None:
+                target = self.buffer[y // n:y // n + tile.shape[0], x // n:x // n + tile.shape[1]]
+                target[...] = tile[:target.shape[0], :target.shape[1]]
+        return True
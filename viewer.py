@@ -0,0 +1,6 @@
+import sys
+from pro import main
+
+# Starts the viewer directly, without the chooser window; pro.py loads the rest on first use
+if __name__ == "__main__":
+    main(["viewer"] + sys.argv[1:])